@@ -0,0 +1,70 @@
+import argparse
+import sys
+import time
+
+import parser as grammar
+
+
+# Замер времени разбора большого входа: обычный разбор и разбор с лексером
+# в отдельном потоке (Parser.pipelined).  Выигрыш от потока возможен только
+# на сборке CPython без GIL (3.13t); с GIL потоки лишь чередуются.
+# С ключом --ascent сравниваются разбор по таблицам (Parser.parse) и
+# рекурсивный подъём (Parser.parse_ascent) на одном и том же потоке лексем.
+def measure(parse, text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parse(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description="Замер скорости разбора")
+    args.add_argument("filename", nargs="?", default="input.txt", metavar="файл")
+    args.add_argument("--copies", type=int, default=500,
+                      help="сколько раз повторить файл во входе")
+    args.add_argument("--repeat", type=int, default=3,
+                      help="число замеров, берётся лучший")
+    args.add_argument("--ascent", action="store_true",
+                      help="сравнить разбор по таблицам с рекурсивным подъёмом")
+    args = args.parse_args(argv)
+
+    with open(args.filename) as f:
+        text = f.read() * args.copies
+
+    p = grammar.p
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"Вход: {len(text)} символов, GIL {'включён' if gil else 'выключен'}")
+
+    if args.ascent:
+        # лексемы получены заранее, замеряется только разбор
+        tokens = p.tokenize_buffer(text)
+        print(f"Лексем: {len(tokens)}")
+        # код рекурсивного подъёма строится при первом разборе
+        p.parse_ascent(tokens)
+        table = measure(p.parse, tokens, args.repeat)
+        print(f"Разбор по таблицам: {table:.3f} с")
+        ascent = measure(p.parse_ascent, tokens, args.repeat)
+        print(f"Рекурсивный подъём: {ascent:.3f} с ({table / ascent:.2f}x)")
+        return
+
+    # лексер в потоке не знает состояния парсера и не сужается по нему,
+    # поэтому для сравнения оба замера идут без контекстного лексера
+    context_lexing, p.context_lexing = p.context_lexing, False
+    p.pipelined = False
+    try:
+        plain = measure(p.parse, text, args.repeat)
+        print(f"Обычный разбор:    {plain:.3f} с")
+
+        p.pipelined = True
+        pipelined = measure(p.parse, text, args.repeat)
+    finally:
+        p.pipelined = False
+        p.context_lexing = context_lexing
+    print(f"Лексер в потоке:   {pipelined:.3f} с ({plain / pipelined:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
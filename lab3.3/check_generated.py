@@ -0,0 +1,81 @@
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+
+import parser as grammar
+import parser_edsl as pe
+
+
+# Проверка парсера, сгенерированного Parser.generate_source(): на входном
+# файле и его вариантах с ошибками он должен давать то же дерево, а на
+# ошибках — ту же позицию и то же сообщение, что и Parser.parse.
+def variants(text):
+    yield "исходный файл", text
+    yield "лишний символ", text.replace("struct Coords", "struct @Coords", 1)
+    yield "пропущена запятая", text.replace("int x, y;", "int x y;", 1)
+    yield "пустой вход", ""
+    yield "оборванное объявление", "struct"
+    yield "выражение в перечислении", "enum E { A = 1 + 2 * (3 - 4) / 5 };"
+    yield "массивы и указатели", "struct S { int a[3][sizeof(int)]; } s, *t, **u;"
+    yield "умножение и указатель", "enum { A = 2 * 3 }; struct S { int *a[A * 2]; };"
+    # ключевое слово в начале более длинного идентификатора
+    yield "идентификатор enumeration", "enumeration;"
+    yield "идентификатор structure", "struct S { structure y; };"
+    yield "идентификаторы с ключевыми словами", "struct S { int integer, *charge; } doubles;"
+    yield "слишком большая константа", "enum { A, B = 999999999999999999 };"
+    # файл, оборванный после каждой лексемы ";" и "}", и без каждой из них
+    for i, c in enumerate(text):
+        if c in ";}":
+            yield f"обрыв на позиции {i}", text[:i]
+            yield f"без символа на позиции {i}", text[:i] + text[i + 1:]
+
+
+def outcome(parse, text, errors):
+    try:
+        return repr(parse(text))
+    except errors as e:
+        return f"Ошибка {e.pos}: {e.message}"
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("generated_parser", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main(argv=None):
+    args = argparse.ArgumentParser(description="Сверка сгенерированного парсера с Parser.parse")
+    args.add_argument("filename", nargs="?", default="input.txt", metavar="файл")
+    args = args.parse_args(argv)
+
+    with open(args.filename) as f:
+        text = f.read()
+
+    p = grammar.p
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "generated_parser.py")
+        p.generate_source(path)
+        generated = load(path)
+    # свёртки из parser.py не импортируются, их передаёт bind()
+    generated.bind([fold.callee for _, _, fold, _ in p.productions])
+
+    errors = (pe.Error, generated.ParseError)
+    failed = 0
+    total = 0
+    for title, source in variants(text):
+        expected = outcome(p.parse, source, errors)
+        # лексер, а не готовые лексемы: парсер сужает его по состоянию, как Parser.parse
+        actual = outcome(lambda s: generated.parse(p.make_lexer(s)), source, errors)
+        total += 1
+        if expected != actual:
+            failed += 1
+            print(f"Расхождение ({title}):\n  Parser.parse: {expected}\n  сгенерированный: {actual}")
+    print(f"Проверено входов: {total}, расхождений: {failed}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
 import parser_edsl as pe
 import abc
+import argparse
 import enum
+import os
 import sys
 import typing
 from dataclasses import dataclass
@@ -560,11 +562,12 @@ MINUS = pe.Terminal("-", "[-]", str)
 DIV = pe.Terminal("/", "[/]", str)
 MUL = pe.Terminal("*", "[*]", str)
 INTEGER = pe.Terminal("INTEGER", "[0-9]+", int)
-IDENTIFIER = pe.Terminal("IDENTIFIER", "[a-zA-Z][a-zA-Z0-9_]*", str)
+# одинаковые идентификаторы разделяют один объект строки
+IDENTIFIER = pe.Terminal("IDENTIFIER", "[a-zA-Z][a-zA-Z0-9_]*", str, intern=True)
 
 
 def make_keyword(image):
-    return pe.Terminal(image, image, lambda name: None, priority=10)
+    return IDENTIFIER.keyword(image)
 
 
 KW_STRUCT, KW_UNION, KW_ENUM, KW_INT, KW_CHAR, KW_DOUBLE, KW_SIZEOF = map(
@@ -765,14 +768,39 @@ NEnumTerm |= KW_SIZEOF, "(", NTypeSpecifier, ")", SizeofTerm.create
 NEnumTerm |= "(", NEnumExpr, ")", lambda expr: expr
 
 # Парсер
-p = pe.Parser(NProgram)
+# таблицы разбора кешируются рядом с байт-кодом, пока грамматика не изменится
+# лексер распознаёт только терминалы, ожидаемые в текущем состоянии:
+# иначе литерал '*' указателя перебивает MUL в выражениях перечислений
+p = pe.Parser(NProgram, context_lexing=True,
+              cache_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__"))
 p.add_skipped_domain("\\s")
+# после ";" можно резать вход на куски для Parser.tokenize_parallel
+p.add_chunk_boundary(";")
 
 # Обработка входных файлов
-for filename in sys.argv[1:]:
-    try:
-        with open(filename) as f:
-            tree = p.parse(f.read())
+def main(argv=None):
+    args = argparse.ArgumentParser(description="Разбор объявлений структур и перечислений")
+    args.add_argument("filenames", nargs="*", metavar="файл")
+    args.add_argument("--lexer-module", metavar="путь",
+                      help="сгенерированный лексер, пересоздаётся при изменении грамматики")
+    args.add_argument("--lex-stats", action="store_true",
+                      help="после разбора каждого файла печатать профиль лексера по терминалам")
+    args = args.parse_args(argv)
+
+    if args.lexer_module is not None:
+        p.load_lexer(args.lexer_module)
+    p.profile_lexer = args.lex_stats
+
+    for filename in args.filenames:
+        try:
+            # файл отображается в память и разбирается без декодирования целиком
+            tree = p.parse_file(filename)
             consts = tree.check()
-    except pe.Error as e:
-        print(f"Ошибка {e.pos}: {e.message}")
+        except pe.Error as e:
+            print(f"Ошибка {e.pos}: {e.message}")
+        if args.lex_stats and p.last_lex_stats is not None:
+            print(p.last_lex_stats.report())
+
+
+if __name__ == "__main__":
+    main()
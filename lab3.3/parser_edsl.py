@@ -1,8 +1,29 @@
 import abc
+import array
+import bisect
+import builtins
+import codecs
 import collections
 import dataclasses
+import hashlib
+import importlib.util
+import itertools
+import math
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import queue
 import re
 import sys
+import threading
+import time
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
 
 
 __all__ = '''
@@ -18,9 +39,13 @@ Left
 Right
 NonAssoc
 TokenAttributeError
+INITIAL_MODE
 '''.split()
 
 
+INITIAL_MODE = 'INITIAL'
+
+
 @dataclasses.dataclass(frozen=True)
 class Precedence:
     level: int
@@ -53,7 +78,9 @@ class Symbol:
 
 
 class BaseTerminal(Symbol):
-    pass
+    # terminals are numbered in the order they are created, so the tables
+    # and the lexer tie-breaking are the same from run to run
+    serials = itertools.count()
 
 
 def pos_from_offset(text, offset):
@@ -64,12 +91,21 @@ def pos_from_offset(text, offset):
 
 
 class Terminal(BaseTerminal):
-    def __init__(self, name, regex, func, *, priority=5, re_flags=re.MULTILINE):
+    def __init__(self, name, regex, func, *, priority=5, re_flags=re.MULTILINE,
+                 modes=None, push=None, pop=False, intern=False):
+        self.serial = next(BaseTerminal.serials)
         self.name = name
         self.regex = regex
         self.func = func
         self.priority = priority
+        # str attributes are interned, so equal lexemes share one object
+        self.intern = intern
         self.re = re.compile(regex, re_flags)
+        # lexer start conditions: the terminal is only matched in the given
+        # modes; after a match the lexer pops and then pushes a mode
+        self.modes = frozenset(modes) if modes is not None else frozenset([INITIAL_MODE])
+        self.push = push
+        self.pop = pop
 
     def __repr__(self):
         return f'Terminal({self.name!r},{self.regex!r},{self.func!r})'
@@ -81,17 +117,48 @@ class Terminal(BaseTerminal):
         m = self.re.match(string, pos)
         if m != None:
             begin, end = m.span()
-            try:
-                attrib = self.func(string[begin:end])
-            except TokenAttributeError as exc:
-                raise LexerError(pos_from_offset(string, begin), string, message=exc.message) from exc
-            return end - begin, attrib
+            return end - begin, self.attribute(string, begin, end)
         else:
             return 0, None
 
+    def attribute(self, string, begin, end, index=None):
+        try:
+            attr = self.func(string[begin:end])
+        except TokenAttributeError as exc:
+            pos = index.position(begin) if index is not None else pos_from_offset(string, begin)
+            raise LexerError(pos, string, message=exc.message, offset=begin) from exc
+        if self.intern and type(attr) is str:
+            attr = sys.intern(attr)
+        return attr
+
+    def keyword(self, image, *, priority=10):
+        if not self.re.fullmatch(image):
+            raise ValueError(f'Keyword {image!r} is not matched by {self.name}')
+        return KeywordTerminal(image, self, priority=priority)
+
+
+class KeywordTerminal(Terminal):
+    # Where its identifier terminal is matched too, the lexer does not try
+    # the keyword regex: it looks the identifier lexeme up in a dict.
+    def __init__(self, image, identifier, *, priority=10):
+        super().__init__(image, re.escape(image), None, priority=priority,
+                         re_flags=identifier.re.flags, modes=identifier.modes)
+        self.identifier = identifier
+
+    def __repr__(self):
+        return f'KeywordTerminal({self.name!r},{self.identifier.name!r})'
+
+    def attribute(self, string, begin, end, index=None):
+        return None
+
 
 class LiteralTerminal(BaseTerminal):
+    modes = frozenset([INITIAL_MODE])
+    push = None
+    pop = False
+
     def __init__(self, image):
+        self.serial = next(BaseTerminal.serials)
         self.image = image
         self.priority = 10
 
@@ -113,6 +180,9 @@ class LiteralTerminal(BaseTerminal):
         else:
             return 0, None
 
+    def attribute(self, string, begin, end, index=None):
+        return None
+
 
 class SpecTerminal(BaseTerminal):
     def __init__(self, name):
@@ -141,13 +211,15 @@ class ErrorTerminal(BaseTerminal):
 @dataclasses.dataclass(frozen = True)
 class ExAction:
     callee : object
+    # the fold of the attributes only that callee wraps, if any
+    simple : object = None
 
     @staticmethod
     def wrap_simple_action(simple_fold):
         def extended_action(attrs, coords, res_coord):
             return simple_fold(*attrs)
 
-        return ExAction(extended_action)
+        return ExAction(extended_action, simple_fold)
 
 
 class NonTerminal(Symbol):
@@ -248,16 +320,10 @@ class Position:
     col : int = 1
 
     def shift(self, text : str):
-        offset, line, col = dataclasses.astuple(self)
-
-        for char in text:
-            if char == '\n':
-                line += 1
-                col = 1
-            else:
-                col += 1
-
-        return Position(offset + len(text), line, col)
+        newlines = text.count('\n')
+        if newlines == 0:
+            return Position(self.offset + len(text), self.line, self.col + len(text))
+        return Position(self.offset + len(text), self.line + newlines, len(text) - text.rfind('\n'))
 
     def __str__(self):
         return f'({self.line}, {self.col})'
@@ -271,6 +337,131 @@ class Fragment:
     def __str__(self):
         return f'{self.start}-{self.following}'
 
+    def join(self, other):
+        return Fragment(self.start, other.following)
+
+    def at_start(self):
+        return Fragment(self.start, self.start)
+
+
+class LineIndex:
+    def __init__(self, text):
+        self.text = text
+        self.__line_starts = None
+
+    def line_starts(self):
+        if self.__line_starts is None:
+            lengths = [len(line) + 1 for line in self.text.split('\n')]
+            lengths[-1:] = []
+            self.__line_starts = [0, *itertools.accumulate(lengths)]
+        return self.__line_starts
+
+    def position(self, offset):
+        starts = self.line_starts()
+        line = bisect.bisect_right(starts, offset)
+        return Position(offset, line, offset - starts[line - 1] + 1)
+
+
+class StreamLineIndex(LineIndex):
+    def __init__(self):
+        self.size = 0
+        self.starts = array.array('q', [0])
+
+    def feed(self, chunk):
+        base = self.size
+        self.starts.extend(base + m.end() for m in re.finditer('\n', chunk))
+        self.size += len(chunk)
+
+    def line_starts(self):
+        return self.starts
+
+
+class MappedLineIndex(LineIndex):
+    def __init__(self, data):
+        super().__init__(data)
+        self.starts = None
+
+    def line_starts(self):
+        if self.starts is None:
+            self.starts = array.array('q', [0])
+            self.starts.extend(m.end() for m in re.finditer(b'\n', self.text))
+        return self.starts
+
+
+class MappedText:
+    # slices of an ASCII byte buffer as str, for attributes and messages
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key].decode('ascii')
+
+
+class OffsetFragment:
+    __slots__ = ('begin', 'end', 'index')
+
+    def __init__(self, begin, end, index):
+        self.begin = begin
+        self.end = end
+        self.index = index
+
+    @property
+    def start(self):
+        return self.index.position(self.begin)
+
+    @property
+    def following(self):
+        return self.index.position(self.end)
+
+    def __eq__(self, other):
+        if isinstance(other, OffsetFragment):
+            return (self.begin, self.end) == (other.begin, other.end)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.begin, self.end))
+
+    def __repr__(self):
+        return f'OffsetFragment({self.begin!r}, {self.end!r})'
+
+    def __str__(self):
+        return f'{self.start}-{self.following}'
+
+    def join(self, other):
+        return OffsetFragment(self.begin, other.end, self.index)
+
+    def at_start(self):
+        return OffsetFragment(self.begin, self.begin, self.index)
+
+
+class LazyAttribute:
+    __slots__ = ('terminal', 'text', 'begin', 'end', 'index')
+
+    def __init__(self, terminal, text, begin, end, index=None):
+        self.terminal = terminal
+        self.text = text
+        self.begin = begin
+        self.end = end
+        self.index = index
+
+    def __repr__(self):
+        return f'LazyAttribute({self.terminal}, {self.begin!r}, {self.end!r})'
+
+    def value(self):
+        return self.terminal.attribute(self.text, self.begin, self.end, self.index)
+
+    def lexeme(self):
+        return self.text[self.begin:self.end]
+
+
+def resolve_attribute(attr):
+    return attr.value() if type(attr) is LazyAttribute else attr
+
 
 @dataclasses.dataclass
 class Token:
@@ -279,12 +470,105 @@ class Token:
     attr : object
 
     def __str__(self):
-        if self.attr is not None:
-            return f'{self.type}({self.attr})'
+        # error messages show a lazy attribute by its text: converting it
+        # may fail, and a keyword has none
+        attr = self.attr
+        if type(attr) is LazyAttribute:
+            attr = None if isinstance(attr.terminal, KeywordTerminal) else attr.lexeme()
+        if attr is not None:
+            return f'{self.type}({attr})'
         else:
             return str(self.type)
 
 
+class TokenBuffer:
+    LAZY = -2
+
+    def __init__(self, symbols, index, text):
+        self.symbols = tuple(symbols)
+        self.ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.index = index
+        # lazy attributes are taken from it; the index of a byte buffer
+        # holds the bytes, this one decodes them
+        self.text = text
+        self.end = 0
+
+        self.types = array.array('H' if len(self.symbols) < 1 << 16 else 'I')
+        self.starts = array.array('q')
+        self.ends = array.array('q')
+        # position of the token attribute in self.attrs, -1 for None,
+        # LAZY when it is converted from the token text on access
+        self.attr_refs = array.array('q')
+        self.attrs = []
+
+    def append(self, type_id, start, end, attr):
+        self.types.append(type_id)
+        self.starts.append(start)
+        self.ends.append(end)
+        if attr is None:
+            self.attr_refs.append(-1)
+        elif type(attr) is LazyAttribute:
+            self.attr_refs.append(self.LAZY)
+        else:
+            self.attr_refs.append(len(self.attrs))
+            self.attrs.append(attr)
+
+    def append_lazy(self, type_id, start, end):
+        self.types.append(type_id)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.attr_refs.append(self.LAZY)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.types)
+        if not 0 <= i < len(self.types):
+            raise IndexError('TokenBuffer index out of range')
+        ref = self.attr_refs[i]
+        start, end = self.starts[i], self.ends[i]
+        symbol = self.symbols[self.types[i]]
+        if ref >= 0:
+            attr = self.attrs[ref]
+        elif ref == self.LAZY:
+            attr = LazyAttribute(symbol, self.text, start, end, self.index)
+        else:
+            attr = None
+        return Token(symbol, OffsetFragment(start, end, self.index), attr)
+
+    def reader(self):
+        return TokenBufferReader(self)
+
+
+class TokenBufferReader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.tokens = self.__tokens(buffer)
+
+    def next_token(self, expected=None):
+        return next(self.tokens)
+
+    @staticmethod
+    def __tokens(buffer):
+        # the tokens of buffer[i] in order, then EOF for good
+        symbols, attrs, text, index = buffer.symbols, buffer.attrs, buffer.text, buffer.index
+        for type_id, start, end, ref in zip(buffer.types, buffer.starts, buffer.ends,
+                                            buffer.attr_refs):
+            symbol = symbols[type_id]
+            if ref >= 0:
+                attr = attrs[ref]
+            elif ref == TokenBuffer.LAZY:
+                attr = LazyAttribute(symbol, text, start, end, index)
+            else:
+                attr = None
+            yield Token(symbol, OffsetFragment(start, end, index), attr)
+        end = buffer.end
+        while True:
+            yield Token(EOF_SYMBOL, OffsetFragment(end, end, index), None)
+
+
 class LrZeroItemTableEntry:
     def __init__(self):
         self.propagates_to = set()
@@ -295,71 +579,124 @@ class LrZeroItemTableEntry:
         return pattern % (repr(self.propagates_to), repr(self.lookaheads))
 
 
-Shift = collections.namedtuple('Shift', 'state')
-Reduce = collections.namedtuple('Reduce', 'rule')
-Accept = collections.namedtuple('Accept', '')
+class ParserAction:
+    # plain namedtuples would make Shift(n) == Reduce(n), and one of them
+    # would be lost from the set of actions of a table entry
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+
+class Shift(ParserAction, collections.namedtuple('Shift', 'state')):
+    __slots__ = ()
+
+
+class Reduce(ParserAction, collections.namedtuple('Reduce', 'rule')):
+    __slots__ = ()
+
+
+class Accept(ParserAction, collections.namedtuple('Accept', '')):
+    __slots__ = ()
 
 
 class ParsingTable:
-    def __init__(self, gr):
+    ACTION_TYPES = (Shift, Reduce, Accept)
+
+    def __init__(self, gr, cached=None):
         self.grammar = gr
 
-        self.terminals = ()
-        self.nonterms = ()
-        self.__ccol = ()
+        self.terminals = gr.terminals + tuple([EOF_SYMBOL])
+        self.nonterms = gr.nonterms[1:]
+        self.kernel_items = ()
         self.n_states = 0
 
+        # rows only hold the terminals and nonterminals with an entry
         self.goto = ()
         self.action = ()
+        self.compressed = None
 
-        self.__setup_from_grammar(self.grammar)
+        if cached is None:
+            self.__setup_from_grammar(self.grammar)
+            self.compressed = CompressedTable(self)
+        else:
+            self.__setup_from_cache(cached[:3])
+            self.compressed = CompressedTable(self, cached[3])
 
     def __setup_from_grammar(self, gr):
-        self.terminals = gr.terminals + tuple([EOF_SYMBOL])
-        self.nonterms = gr.nonterms[1:]
-
-        self.__ccol = tuple(get_canonical_collection(gr))
-        self.n_states = len(self.__ccol)
-
-        ccol_core = tuple(drop_itemset_lookaheads(x) for x in self.__ccol)
-        id_from_core = {ccol_core[i]: i for i in range(len(self.__ccol))}
+        # the states of the LALR(1) collection are the states of the LR(0)
+        # automaton in the same order, so are its transitions
+        dfa = LR0_Automaton(gr)
+        if gr.lalr_method == 'relations':
+            states = get_lalr_lookaheads(gr, dfa)
+        else:
+            states = [lookahead_masks(gr, item_set)
+                      for item_set in get_canonical_collection(gr, dfa)]
+        self.n_states = len(states)
 
-        self.goto = tuple({x: None for x in self.nonterms} for i in range(self.n_states))
-        self.action = tuple({x: set() for x in self.terminals} for i in range(self.n_states))
-
-        goto_precalc = tuple(dict() for i in range(self.n_states))
-        for symbol in (self.terminals + self.nonterms):
-            for state_id in range(self.n_states):
-                next_state = goto(gr, self.__ccol[state_id], symbol)
-                if len(next_state) == 0:
-                    continue
-                next_state_id = id_from_core[drop_itemset_lookaheads(next_state)]
-                goto_precalc[state_id][symbol] = next_state_id
+        self.goto = tuple(dict() for i in range(self.n_states))
+        self.action = tuple(dict() for i in range(self.n_states))
 
         for state_id in range(self.n_states):
-            for item, next_symbol in self.__ccol[state_id]:
+            for item, mask in states[state_id].items():
                 prod_index, dot = item
                 _, pbody, _, _ = gr.productions[prod_index]
 
                 if dot < len(pbody):
-                    terminal = pbody[dot]
-                    if not isinstance(terminal, BaseTerminal) or terminal not in goto_precalc[state_id]:
-                        continue
-
-                    next_state_id = goto_precalc[state_id][terminal]
-                    self.action[state_id][terminal].add(Shift(next_state_id))
-                else:
-                    if prod_index == 0:
-                        assert (next_symbol == EOF_SYMBOL)
-                        self.action[state_id][EOF_SYMBOL].add(Accept())
+                    symbol = pbody[dot]
+                    next_state_id = dfa.goto[(state_id, symbol)]
+                    if isinstance(symbol, BaseTerminal):
+                        self.action[state_id].setdefault(symbol, set()).add(Shift(next_state_id))
                     else:
-                        self.action[state_id][next_symbol].add(Reduce(prod_index))
-
-            for nt in self.nonterms:
-                if nt not in goto_precalc[state_id]:
-                    continue
-                next_state_id = goto_precalc[state_id][nt]
-                self.goto[state_id][nt] = next_state_id
+                        self.goto[state_id][symbol] = next_state_id
+                elif prod_index == 0:
+                    assert (mask == gr.terminal_bits[EOF_SYMBOL])
+                    self.action[state_id].setdefault(EOF_SYMBOL, set()).add(Accept())
+                else:
+                    for next_symbol in gr.terminals_of(mask):
+                        self.action[state_id].setdefault(next_symbol, set()).add(Reduce(prod_index))
+
+        self.kernel_items = tuple(frozenset(item for item in items if item[1] > 0 or item[0] == 0)
+                                  for items in states)
+
+    def __setup_from_cache(self, cached):
+        kernel_items, action, goto = cached
+        self.n_states = len(kernel_items)
+        if len(action) != self.n_states or len(goto) != self.n_states:
+            raise ValueError('Cached table does not match the grammar')
+        self.kernel_items = tuple(frozenset(items) for items in kernel_items)
+        self.goto = tuple(dict() for i in range(self.n_states))
+        self.action = tuple(dict() for i in range(self.n_states))
+        n_rules = len(self.grammar.productions)
+        for state_id in range(self.n_states):
+            for terminal, entries in action[state_id]:
+                actions = {self.ACTION_TYPES[code](*args) for code, *args in entries}
+                if terminal < 0 or any(isinstance(act, Shift) and not 0 <= act.state < self.n_states
+                                       or isinstance(act, Reduce) and not 0 < act.rule < n_rules
+                                       for act in actions):
+                    raise ValueError('Cached table does not match the grammar')
+                self.action[state_id][self.terminals[terminal]] = actions
+            for nt, next_state_id in goto[state_id]:
+                if nt < 0 or not 0 <= next_state_id < self.n_states:
+                    raise ValueError('Cached table does not match the grammar')
+                self.goto[state_id][self.nonterms[nt]] = next_state_id
+
+    def to_cache(self):
+        terminal_ids = {x: i for i, x in enumerate(self.terminals)}
+        nonterm_ids = {x: i for i, x in enumerate(self.nonterms)}
+        codes = {t: code for code, t in enumerate(self.ACTION_TYPES)}
+        kernel_items = [sorted(items) for items in self.kernel_items]
+        action = [[(terminal_ids[t], [(codes[type(a)],) + tuple(a) for a in entries])
+                   for t, entries in row.items() if entries]
+                  for row in self.action]
+        goto = [[(nonterm_ids[nt], sid) for nt, sid in row.items() if sid is not None]
+                for row in self.goto]
+        return kernel_items, action, goto, self.compressed.to_cache()
 
     @staticmethod
     def __stringify_action_entries(term, ent):
@@ -378,11 +715,11 @@ class ParsingTable:
 
     def stringify_state(self, state_id):
         state_title = 'State %d\n' % state_id
-        items = drop_itemset_lookaheads(kernels(self.__ccol[state_id]))
-        items = sorted(items, key=lambda elem: elem[0])
+        items = sorted(self.kernel_items[state_id], key=lambda elem: elem[0])
         items_str = '\n'.join('\t' + self.__stringify_lr_zero_item(item) for item in items) + '\n\n'
         # TODO CHANGED FOR TERMINALS MAYBE WRONG
-        actions = [(t, e) for t, e in self.action[state_id].items() if len(e) > 0]
+        row = self.action[state_id]
+        actions = [(t, row[t]) for t in self.terminals if len(row.get(t, ())) > 0]
         actions_str = '\n'.join(self.__stringify_action_entries(t, e) for t, e in actions)
         actions_str += ('\n' if len(actions_str) > 0 else '')
 
@@ -418,8 +755,305 @@ class ParsingTable:
         return (STATUS_OK if len(seq) == 0 else max(seq)) == STATUS_OK
 
 
-def get_canonical_collection(gr):
-    dfa = LR0_Automaton(gr)
+class CompressedTable:
+    # The action and goto tables coded by integers for the LR driver.  An
+    # action > 0 shifts to state action - 1, an action < 0 reduces by rule
+    # -action - 1 (rule 0 accepts), 0 is an error.  The most common reduction
+    # of a state is its default, taken on any terminal the state expects
+    # that has no other entry; the other entries are packed into one array
+    # by row displacement: the entry for (state, t) is next[base[state] + t]
+    # if check[base[state] + t] == state.  Gotos are packed the same way by
+    # nonterminal columns, with the most common target as the default, so
+    # their check holds the nonterminal.
+    ERROR = 0
+
+    def __init__(self, table, cached=None):
+        gr = table.grammar
+        self.terminal_ids = {x: i for i, x in enumerate(table.terminals)}
+        self.nonterm_ids = {x: i for i, x in enumerate(table.nonterms)}
+        self.rule_lhs = array.array('i', [self.nonterm_ids.get(nt, -1) for nt, _, _, _ in gr.productions])
+        self.rule_length = array.array('i', [len(prod) for _, prod, _, _ in gr.productions])
+
+        if cached is not None:
+            (self.expected, self.nonassoc, self.default_reduce, self.action_base,
+             self.action_check, self.action_next, self.default_goto, self.goto_base,
+             self.goto_check, self.goto_next) = cached
+            self.__check(table)
+            return
+
+        rows = []
+        # terminals with any action, by state; they are also the ones that
+        # are reported as expected on an error
+        self.expected = []
+        nonassoc = set()
+        for state_id, row in enumerate(table.action):
+            codes = {}
+            mask = 0
+            for terminal, actions in row.items():
+                if not actions:
+                    continue
+                t = self.terminal_ids[terminal]
+                mask |= 1 << t
+                code = self.resolve(gr, terminal, actions)
+                if code is None:
+                    nonassoc.add((state_id, t))
+                    code = self.ERROR
+                codes[t] = code
+            self.expected.append(mask)
+            rows.append(codes)
+        self.expected = tuple(self.expected)
+        self.nonassoc = frozenset(nonassoc)
+
+        self.default_reduce = array.array('i', bytes(4 * len(rows)))
+        for state_id, codes in enumerate(rows):
+            reductions = collections.Counter(code for code in codes.values() if code < -1)
+            if reductions:
+                default = max(reductions, key=lambda code: (reductions[code], code))
+                self.default_reduce[state_id] = default
+                rows[state_id] = {t: code for t, code in codes.items() if code != default}
+        self.action_base, self.action_check, self.action_next = self.pack(rows, len(table.terminals))
+
+        columns = [{} for nt in table.nonterms]
+        for state_id, row in enumerate(table.goto):
+            for nt, target in row.items():
+                columns[self.nonterm_ids[nt]][state_id] = target
+        self.default_goto = array.array('i', bytes(4 * len(columns)))
+        for nt, column in enumerate(columns):
+            if column:
+                targets = collections.Counter(column.values())
+                default = max(targets, key=lambda target: (targets[target], -target))
+                self.default_goto[nt] = default
+                columns[nt] = {state_id: target for state_id, target in column.items()
+                               if target != default}
+        self.goto_base, self.goto_check, self.goto_next = self.pack(columns, table.n_states)
+
+    def __check(self, table):
+        # every lookup of a cached table stays inside its arrays and leads
+        # to a state or a rule
+        n_states, n_rules = table.n_states, len(self.rule_lhs)
+        n_terminals, n_nonterms = len(table.terminals), len(table.nonterms)
+        valid = (
+            len(self.expected) == len(self.default_reduce) == len(self.action_base) == n_states
+            and len(self.default_goto) == len(self.goto_base) == n_nonterms
+            and len(self.action_check) == len(self.action_next)
+            and len(self.goto_check) == len(self.goto_next)
+            and all(0 <= base and base + n_terminals <= len(self.action_check)
+                    for base in self.action_base)
+            and all(0 <= base and base + n_states <= len(self.goto_check)
+                    for base in self.goto_base)
+            and all(-n_rules <= code <= n_states
+                    for code in itertools.chain(self.default_reduce, self.action_next))
+            and all(0 <= target < n_states
+                    for target in itertools.chain(self.default_goto, self.goto_next))
+            and all(0 <= state < n_states and 0 <= t < n_terminals for state, t in self.nonassoc))
+        if not valid:
+            raise ValueError('Cached table does not match the grammar')
+
+    @staticmethod
+    def resolve(gr, terminal, actions):
+        # a shift/reduce conflict is resolved by precedence; between
+        # reductions the longest rule wins, then the earliest one; None
+        # stands for a non-associative operator
+        shift_action = None
+        reduce_action = None
+        rank = lambda act: (-len(gr.productions[act.rule][1]), act.rule)
+        for act in actions:
+            if isinstance(act, Accept):
+                return -1
+            if isinstance(act, Shift):
+                shift_action = act
+            elif reduce_action is None or rank(act) < rank(reduce_action):
+                reduce_action = act
+        action = shift_action or reduce_action
+        if shift_action is not None and reduce_action is not None:
+            _, prod, _, prod_prec = gr.productions[reduce_action.rule]
+            if prod_prec is None:
+                for sym in reversed(prod):
+                    if isinstance(sym, BaseTerminal):
+                        prod_prec = Precedence(sym.priority, 'left')
+                        break
+            token_prec = terminal.priority
+            if prod_prec is None or token_prec > prod_prec.level:
+                action = shift_action
+            elif token_prec < prod_prec.level:
+                action = reduce_action
+            elif prod_prec.associativity == 'left':
+                action = reduce_action
+            elif prod_prec.associativity == 'right':
+                action = shift_action
+            else:
+                return None
+        if isinstance(action, Shift):
+            return action.state + 1
+        return -action.rule - 1
+
+    @staticmethod
+    def pack(rows, width):
+        # first fit of every row, the densest first
+        base = array.array('i', bytes(4 * len(rows)))
+        check = array.array('i')
+        values = array.array('i')
+        lowest_free = 0
+        for row_id in sorted(range(len(rows)), key=lambda i: -len(rows[i])):
+            row = rows[row_id]
+            if not row:
+                continue
+            columns = sorted(row)
+            offset = max(lowest_free - columns[0], 0)
+            while any(offset + c < len(check) and check[offset + c] != -1 for c in columns):
+                offset += 1
+            base[row_id] = offset
+            end = offset + columns[-1] + 1
+            if end > len(check):
+                check.extend([-1] * (end - len(check)))
+                values.extend([0] * (end - len(values)))
+            for c in columns:
+                check[offset + c] = row_id
+                values[offset + c] = row[c]
+            while lowest_free < len(check) and check[lowest_free] != -1:
+                lowest_free += 1
+        # every lookup of an empty or packed row stays inside the arrays
+        size = max([len(check)] + [b + width for b in base])
+        check.extend([-1] * (size - len(check)))
+        values.extend([0] * (size - len(values)))
+        return base, check, values
+
+    def to_cache(self):
+        return (self.expected, self.nonassoc, self.default_reduce, self.action_base,
+                self.action_check, self.action_next, self.default_goto, self.goto_base,
+                self.goto_check, self.goto_next)
+
+    def action(self, state, t):
+        index = self.action_base[state] + t
+        if self.action_check[index] == state:
+            return self.action_next[index]
+        if self.expected[state] >> t & 1:
+            return self.default_reduce[state]
+        return self.ERROR
+
+    def goto(self, state, nt):
+        index = self.goto_base[nt] + state
+        if self.goto_check[index] == nt:
+            return self.goto_next[index]
+        return self.default_goto[nt]
+
+
+class RecursiveAscent:
+    # The LR automaton coded as Python: a function for every state, called
+    # when the state is entered, with the branches of its actions tested on
+    # terminal bitmasks.  The states on the stack are the calls in progress;
+    # a reduction by a rule of length n returns through n of them with
+    # (n - 1) * len(nonterms) + lhs, the state it returns to takes the goto
+    # on lhs.  Attributes and coordinates of the symbols are kept in two
+    # plain lists.  The functions are made anew by make_parser() for every
+    # parse, as closures over its lexer.  A shift past limit calls raises
+    # TooDeep, before the Python stack overflows.
+    class TooDeep(Exception):
+        pass
+
+    def __init__(self, gr, error):
+        self.source = self.generate(gr)
+        namespace = {'error': error, 'TooDeep': RecursiveAscent.TooDeep}
+        for rule, (_, _, fold, _) in enumerate(gr.productions):
+            namespace['f%d' % rule] = fold.callee
+        exec(compile(self.source, '<recursive ascent>', 'exec'), namespace)
+        self.make_parser = namespace['make_parser']
+
+    @staticmethod
+    def generate(gr):
+        table = gr.table
+        compressed = table.compressed
+        n_nonterms = len(table.nonterms)
+        lines = ['def make_parser(next_token, ids, lazy, resolve, limit):',
+                 '    vs = []',
+                 '    cs = []',
+                 '']
+        for state in range(table.n_states):
+            groups = {}
+            mask = compressed.expected[state]
+            for t in range(len(table.terminals)):
+                if mask >> t & 1:
+                    groups.setdefault(compressed.action(state, t), []).append(t)
+            gotos = sorted((compressed.nonterm_ids[nt], target)
+                           for nt, target in table.goto[state].items())
+
+            lines.append('    def s%d():' % state)
+            if any(code > 0 for code in groups):
+                lines.append('        nonlocal cur, t')
+            branch = 'if'
+            for code, ts in sorted(groups.items(), key=lambda group: -len(group[1])):
+                if code == CompressedTable.ERROR:
+                    continue
+                if len(ts) == 1:
+                    lines.append('        %s t == %d:' % (branch, ts[0]))
+                else:
+                    lines.append('        %s 0x%x >> t & 1:' % (branch, sum(1 << t for t in ts)))
+                branch = 'elif'
+                lines += ['            ' + line for line in
+                          RecursiveAscent.__action(gr, code, gotos, n_nonterms)]
+            if branch == 'if':
+                lines.append('        raise error(%d, cur)' % state)
+            else:
+                lines += ['        else:',
+                          '            raise error(%d, cur)' % state]
+            if gotos:
+                lines.append('        while True:')
+                branch = 'if'
+                for nt, target in gotos:
+                    lines += ['            %s r == %d:' % (branch, nt),
+                              '                r = s%d()' % target]
+                    branch = 'elif'
+                lines += ['            else:',
+                          '                return %s' % ('r' if state == 0 else 'r - %d' % n_nonterms)]
+            lines.append('')
+
+        lines += ['    cur = next_token(0)',
+                  '    t = ids[cur.type]',
+                  '    return s0, vs',
+                  '']
+        return '\n'.join(lines)
+
+    @staticmethod
+    def __action(gr, code, gotos, n_nonterms):
+        if code > 0:
+            return ['vs.append(cur.attr)',
+                    'cs.append(cur.pos)',
+                    'if len(vs) > limit:',
+                    '    raise TooDeep()',
+                    'cur = next_token(%d)' % (code - 1),
+                    't = ids[cur.type]',
+                    'r = s%d()' % (code - 1) if gotos else 'return s%d() - %d' % (code - 1, n_nonterms)]
+        if code == -1:
+            return ['return -1']
+
+        rule = -code - 1
+        n = len(gr.productions[rule][1])
+        lhs = gr.table.compressed.rule_lhs[rule]
+        if n == 0:
+            lines = ['res_coord = cur.pos.at_start()',
+                     'vs.append(f%d([], [], res_coord))' % rule,
+                     'cs.append(res_coord)']
+        else:
+            lines = ['attrs = vs[-%d:]' % n,
+                     'if None in attrs:',
+                     '    attrs = [attr for attr in attrs if attr != None]',
+                     'if lazy:',
+                     '    attrs = resolve(attrs)',
+                     'coords = cs[-%d:]' % n,
+                     'res_coord = coords[0].join(coords[-1])']
+            if n > 1:
+                lines += ['del vs[-%d:]' % (n - 1),
+                          'del cs[-%d:]' % (n - 1)]
+            lines += ['vs[-1] = f%d(attrs, coords, res_coord)' % rule,
+                      'cs[-1] = res_coord']
+        if n == 0:
+            # the goto is taken by this very state
+            return lines + ['r = %d' % lhs]
+        return lines + ['return %d' % ((n - 1) * n_nonterms + lhs)]
+
+
+def get_canonical_collection(gr, dfa=None):
+    dfa = dfa or LR0_Automaton(gr)
     kstates = dfa.kstates()
     n_states = len(kstates)
 
@@ -472,6 +1106,153 @@ def get_canonical_collection(gr):
     return result
 
 
+def lookahead_masks(gr, item_set):
+    # LR(1) items as LR(0) items with the mask of their lookaheads
+    result = {}
+    for item, lookahead in item_set:
+        result[item] = result.get(item, 0) | gr.terminal_bits[lookahead]
+    return result
+
+
+def get_lalr_lookaheads(gr, dfa=None):
+    # The items get_canonical_collection finds in the states, as LR(0)
+    # items with lookahead masks, found by the DeRemer-Pennello relations
+    # over the LR(0) automaton instead of propagation:
+    # Follow(p, A) = Read(p, A) + U{Follow(p', B) | (p, A) includes (p', B)},
+    # LA(q, B -> w) = U{Follow(p', B) | (q, B -> w) lookback (p', B)}.
+    # Read(p, A) is the union of FIRST(d) over the items B -> a . A d of p,
+    # taken from the suffix FIRST masks of the grammar.  The items B -> . w
+    # of a state, e-rules among them, all have the lookaheads of B there.
+    dfa = dfa or LR0_Automaton(gr)
+    kstates = dfa.kstates()
+    transitions = collections.defaultdict(dict)
+    for (state, symbol), target in dfa.goto.items():
+        transitions[state][symbol] = target
+    nonterm_transitions = [(state, symbol) for (state, symbol) in dfa.goto
+                           if isinstance(symbol, NonTerminal)]
+
+    # As in the closure of a kernel item, B -> . w only belongs to p when
+    # something can follow B there.
+    live = set()
+    for state, kernel in enumerate(kstates):
+        queue = list(kernel)
+        while queue:
+            prod_index, dot = queue.pop()
+            pbody = gr.productions[prod_index][1]
+            if dot == len(pbody) or not isinstance(pbody[dot], NonTerminal):
+                continue
+            mask, nullable = gr.suffix_first[prod_index][dot + 1]
+            if (mask or nullable) and (state, pbody[dot]) not in live:
+                live.add((state, pbody[dot]))
+                offset = gr.nonterm_offset[pbody[dot]]
+                queue += [(offset + k, 0) for k in range(len(pbody[dot].productions))]
+
+    read = {x: 0 for x in nonterm_transitions}
+    includes = {x: [] for x in nonterm_transitions}
+    lookback = collections.defaultdict(list)
+    start = gr.productions[0][1][0]
+    read[(0, start)] |= gr.terminal_bits[EOF_SYMBOL]
+    for origin in nonterm_transitions:
+        nt = origin[1]
+        offset = gr.nonterm_offset[nt]
+        for prod_index in range(offset, offset + len(nt.productions)):
+            pbody = gr.productions[prod_index][1]
+            state = origin[0]
+            for dot, symbol in enumerate(pbody):
+                if isinstance(symbol, NonTerminal) and (dot > 0 or origin in live):
+                    mask, nullable = gr.suffix_first[prod_index][dot + 1]
+                    read[(state, symbol)] |= mask
+                    if nullable:
+                        includes[(state, symbol)].append(origin)
+                state = transitions[state][symbol]
+                lookback[(state, (prod_index, dot + 1))].append(origin)
+    follow = digraph(nonterm_transitions, includes, read)
+
+    eof = gr.terminal_bits[EOF_SYMBOL]
+    result = [{(0, 0): eof}] + [{} for kernel in kstates[1:]]
+    result[transitions[0][start]][(0, 1)] = eof
+    for (state, item), origins in lookback.items():
+        mask = 0
+        for origin in origins:
+            mask |= follow[origin]
+        if mask:
+            result[state][item] = result[state].get(item, 0) | mask
+
+    # The rest of the closure of a state, over the masks of nonterminals:
+    # LA(B) holds FIRST(d) for every A -> . B d of the state and LA(A) too
+    # if d is nullable.  These edges depend on the grammar only; a state
+    # picks the nonterminals its kernel reaches and solves them as Follow.
+    heads = collections.defaultdict(list)
+    inherits = collections.defaultdict(list)
+    for prod_index, (head, pbody, _, _) in enumerate(gr.productions):
+        if pbody and isinstance(pbody[0], NonTerminal):
+            mask, nullable = gr.suffix_first[prod_index][1]
+            heads[head].append((pbody[0], mask, nullable))
+            if nullable:
+                inherits[pbody[0]].append(head)
+    for items in result:
+        lookaheads = {}
+        for (prod_index, dot), mask in items.items():
+            pbody = gr.productions[prod_index][1]
+            if dot < len(pbody) and isinstance(pbody[dot], NonTerminal):
+                suffix, nullable = gr.suffix_first[prod_index][dot + 1]
+                added = suffix | (mask if nullable else 0)
+                if added:
+                    lookaheads[pbody[dot]] = lookaheads.get(pbody[dot], 0) | added
+        queue = list(lookaheads)
+        while queue:
+            for nt, mask, nullable in heads[queue.pop()]:
+                if mask or nullable:
+                    if nt not in lookaheads:
+                        lookaheads[nt] = 0
+                        queue.append(nt)
+                    lookaheads[nt] |= mask
+        relation = {nt: [head for head in inherits[nt] if head in lookaheads] for nt in lookaheads}
+        for nt, mask in digraph(list(lookaheads), relation, lookaheads).items():
+            offset = gr.nonterm_offset[nt]
+            for k in range(len(nt.productions)):
+                items[(offset + k, 0)] = items.get((offset + k, 0), 0) | mask
+    return result
+
+
+def digraph(nodes, relation, initial):
+    # F(x) = initial(x) + U{F(y) | x R y}, one SCC pass (DeRemer, Pennello)
+    result = dict(initial)
+    depth = {x: 0 for x in nodes}
+    stack = []
+    for root in nodes:
+        if depth[root] != 0:
+            continue
+        stack.append(root)
+        depth[root] = len(stack)
+        work = [(root, iter(relation[root]), len(stack))]
+        while work:
+            x, edges, d = work[-1]
+            y = next(edges, None)
+            if y is not None:
+                if depth[y] == 0:
+                    stack.append(y)
+                    depth[y] = len(stack)
+                    work.append((y, iter(relation[y]), len(stack)))
+                    continue
+                depth[x] = min(depth[x], depth[y])
+                result[x] |= result[y]
+                continue
+            work.pop()
+            if depth[x] == d:
+                while True:
+                    top = stack.pop()
+                    depth[top] = math.inf
+                    result[top] = result[x]
+                    if top == x:
+                        break
+            if work:
+                parent = work[-1][0]
+                depth[parent] = min(depth[parent], depth[x])
+                result[parent] |= result[x]
+    return result
+
+
 def closure(gr, item_set):
     result = set(item_set)
     current = item_set
@@ -480,12 +1261,14 @@ def closure(gr, item_set):
         new_elements = []
         for ((prod_index, dot), lookahead) in current:
             _, pbody, _, _ = gr.productions[prod_index]
-            if dot == len(pbody) or pbody[dot] not in gr.nonterms:
+            if dot == len(pbody) or not isinstance(pbody[dot], NonTerminal):
                 continue
             nt = pbody[dot]
             nt_offset = gr.nonterm_offset[nt]
-            following_symbols = pbody[dot + 1:] + [lookahead]
-            following_terminals = gr.first_set(following_symbols) - {None}
+            following, nullable = gr.suffix_first[prod_index][dot + 1]
+            if nullable:
+                following |= gr.terminal_bits[lookahead]
+            following_terminals = gr.terminals_of(following)
             for idx in range(len(nt.productions)):
                 for term in following_terminals:
                     new_item_set = ((nt_offset + idx, 0), term)
@@ -553,58 +1336,83 @@ class ParseTreeNode:
 
 
 class PredictiveParsingTable:
-    def __init__(self, grammar):
+    def __init__(self, grammar, cached=None):
         self.grammar = grammar
         self.table = {}
+        self.rules = {}
 
-        self.follow_sets = self._build_follow_sets()
-        self._build_table()
+        if cached is None:
+            self.follow_sets = self._build_follow_sets()
+            self._build_table()
+        else:
+            self._setup_from_cache(cached)
+
+    def _setup_from_cache(self, cached):
+        grammar = self.grammar
+        follow_masks, rules = cached
+        if len(follow_masks) != len(grammar.nonterms) or len(rules) != len(grammar.nonterms):
+            raise ValueError('Cached table does not match the grammar')
+        self.follow_masks = dict(zip(grammar.nonterms, follow_masks))
+        self.follow_sets = {nt: set(grammar.terminals_of(mask)) for nt, mask in self.follow_masks.items()}
+        terminals = grammar.terminals + (EOF_SYMBOL,)
+        for nt, row in zip(grammar.nonterms, rules):
+            self.table[nt] = {}
+            self.rules[nt] = {}
+            for terminal, prod_index in row:
+                if terminal < 0 or not 0 <= prod_index < len(grammar.productions):
+                    raise ValueError('Cached table does not match the grammar')
+                self._add_rule(nt, terminals[terminal], prod_index)
+
+    def to_cache(self):
+        grammar = self.grammar
+        terminal_ids = {x: i for i, x in enumerate(grammar.terminals + (EOF_SYMBOL,))}
+        follow_masks = [self.follow_masks[nt] for nt in grammar.nonterms]
+        rules = [[(terminal_ids[t], prod_index) for t, prod_index in self.rules[nt].items()]
+                 for nt in grammar.nonterms]
+        return follow_masks, rules
 
     def _build_follow_sets(self):
-        follow = {nt: set() for nt in self.grammar.nonterms}
-        start_nt = self.grammar.nonterms[0]
+        grammar = self.grammar
+        follow = {nt: 0 for nt in grammar.nonterms}
+        start_nt = grammar.nonterms[0]
 
-        follow[start_nt].add(EOF_SYMBOL)
+        follow[start_nt] = grammar.terminal_bits[EOF_SYMBOL]
 
         changed = True
         while changed:
             changed = False
-            for (nt, prod, _, _) in self.grammar.productions:
+            for prod_index, (nt, prod, _, _) in enumerate(grammar.productions):
                 for i, sym in enumerate(prod):
-                    if sym not in self.grammar.nonterms:
+                    if not isinstance(sym, NonTerminal):
                         continue
-                    beta = prod[i+1:]
-                    first_of_beta = self.grammar.first_set(beta)
-                    before_len = len(follow[sym])
-
-                    without_epsilon = set(first_of_beta) - {None}
-                    follow[sym].update(without_epsilon)
-
-                    if None in first_of_beta:
-                        follow[sym].update(follow[nt])
-
-                    after_len = len(follow[sym])
-                    if after_len > before_len:
+                    mask, nullable = grammar.suffix_first[prod_index][i + 1]
+                    if nullable:
+                        mask |= follow[nt]
+                    if mask & ~follow[sym]:
+                        follow[sym] |= mask
                         changed = True
-        return follow
+        self.follow_masks = follow
+        return {nt: set(grammar.terminals_of(mask)) for nt, mask in follow.items()}
 
     def _build_table(self):
         for nt in self.grammar.nonterms:
             self.table[nt] = {}
+            self.rules[nt] = {}
 
         for i, (nt, prod, fold, _) in enumerate(self.grammar.productions):
-            fs = self.grammar.first_set(prod)
-            non_epsilon = fs - {None}
-            for t in non_epsilon:
-                self._add_rule(nt, t, prod, fold)
+            mask, nullable = self.grammar.suffix_first[i][0]
+            for t in self.grammar.terminals_of(mask):
+                self._add_rule(nt, t, i)
 
-            if None in fs:
-                for t in self.follow_sets[nt]:
-                    self._add_rule(nt, t, prod, fold)
+            if nullable:
+                for t in self.grammar.terminals_of(self.follow_masks[nt]):
+                    self._add_rule(nt, t, i)
 
-    def _add_rule(self, nt, terminal, prod, fold):
+    def _add_rule(self, nt, terminal, prod_index):
+        _, prod, fold, _ = self.grammar.productions[prod_index]
         if terminal not in self.table[nt]:
             self.table[nt][terminal] = (prod, fold)
+            self.rules[nt][terminal] = prod_index
         else:
             existing = self.table[nt][terminal]
             raise PredictiveTableConflictError(
@@ -626,7 +1434,34 @@ class PredictiveParsingTable:
 
 
 class Parser(object):
-    def __init__(self, start_nonterminal):
+    POSITION_MODES = ('eager', 'offsets')
+    LALR_METHODS = ('propagation', 'relations')
+
+    def __init__(self, start_nonterminal, *, positions='eager', lazy_attributes=False,
+                 context_lexing=False, max_token_length=4096, chunk_size=65536,
+                 profile_lexer=False, pipelined=False, lalr_method='propagation',
+                 cache_dir=None):
+        if positions not in self.POSITION_MODES:
+            raise ValueError(f'Unknown positions mode {positions!r}')
+        if lalr_method not in self.LALR_METHODS:
+            raise ValueError(f'Unknown LALR method {lalr_method!r}')
+        # how LALR(1) lookaheads are found: by propagation from kernel items
+        # or by the DeRemer-Pennello relations
+        self.lalr_method = lalr_method
+        self.positions = positions
+        self.lazy_attributes = lazy_attributes
+        self.context_lexing = context_lexing
+        # every lexer made by the parser records a LexerStats here
+        self.profile_lexer = profile_lexer
+        self.last_lex_stats = None
+        # parse() lexes on a separate thread, unless lexing depends on the
+        # parser state
+        self.pipelined = pipelined
+        self.max_token_length = max_token_length
+        self.chunk_size = chunk_size
+        # the tables are stored there under the grammar fingerprint and are
+        # not built again while the grammar stays the same
+        self.cache_dir = cache_dir
 
         fake_axiom = NonTerminal(START_SYMBOL)
         fake_axiom |= start_nonterminal
@@ -666,16 +1501,78 @@ class Parser(object):
 
             scanned_count = last_unscanned
 
-        self.terminals = tuple(sorted(self.terminals, key=id))
+        self.terminals = tuple(sorted(self.terminals, key=lambda t: t.serial))
         self.nonterms = tuple(sorted(self.nonterms, key=lambda nt: nt.name))
         self.symbols = self.nonterms + self.terminals
+        # sets of terminals are kept as bitmasks over this numbering
+        self.terminal_bits = {symbol: 1 << k for k, symbol
+                              in enumerate(self.terminals + (EOF_SYMBOL, FREE_SYMBOL))}
+        self.__terminals_of = {}
+        self.suffix_first = ()
         self.skipped_domains = []
+        self.chunk_boundaries = []
+        self.__lexer_engine = None
+        self.__byte_lexer_engine = None
+        self.__expected_terminals = None
+        self.__ascent = None
 
         self.__build_first_sets()
-        self.table = ParsingTable(self)
-
         self.ll1_table = None
         self.ll1_is_ok = True
+        cached = self.__read_table_cache()
+        if cached is not None:
+            # a cache of another structure is built again and overwritten
+            try:
+                self.table = ParsingTable(self, cached['lalr'])
+                if cached['ll1'] is not None:
+                    self.ll1_table = PredictiveParsingTable(self, cached['ll1'])
+            except (LookupError, TypeError, ValueError, Error):
+                self.ll1_table = None
+                cached = None
+        if cached is None:
+            self.table = ParsingTable(self)
+            self.__write_table_cache()
+
+    TABLE_CACHE_VERSION = 2
+
+    def table_fingerprint(self):
+        ids = {symbol: i for i, symbol in enumerate(self.symbols)}
+        signature = [self.TABLE_CACHE_VERSION, self.lalr_method,
+                     LexerEngine.fingerprint(self.terminals, ()),
+                     [nt.name for nt in self.nonterms]]
+        for nt, prod, _, prec in self.productions:
+            prec = (prec.level, prec.associativity) if prec is not None else None
+            signature.append((ids[nt], tuple(ids[symbol] for symbol in prod), prec))
+        return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+    def __table_cache_path(self):
+        return os.path.join(self.cache_dir, f'tables-{self.table_fingerprint()}.pickle')
+
+    def __read_table_cache(self):
+        if self.cache_dir is None:
+            return None
+        # unpickling may fail in many ways; an unreadable cache is not used
+        try:
+            with open(self.__table_cache_path(), 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def __write_table_cache(self):
+        if self.cache_dir is None:
+            return
+        path = self.__table_cache_path()
+        cached = {'lalr': self.table.to_cache(),
+                  'll1': self.ll1_table.to_cache() if self.ll1_table is not None else None}
+        # a cache that cannot be written is just not used
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
 
     def first_set(self, x):
         result = set()
@@ -691,25 +1588,56 @@ class Parser(object):
             result.add(None)
         return frozenset(result)
 
+    def terminals_of(self, mask):
+        terminals = self.__terminals_of.get(mask)
+        if terminals is None:
+            terminals = tuple(symbol for symbol, bit in self.terminal_bits.items() if mask & bit)
+            self.__terminals_of[mask] = terminals
+        return terminals
+
+    def __sequence_first(self, symbols, first, nullable):
+        mask = 0
+        for sym in symbols:
+            if not isinstance(sym, NonTerminal):
+                return mask | self.terminal_bits[sym], False
+            mask |= first[sym]
+            if sym not in nullable:
+                return mask, False
+        return mask, True
+
     def __build_first_sets(self):
-        for s in self.nonterms:
-            self.__first_sets[s] = set()
-            if [] in s.productions:
-                self.__first_sets[s].add(None)
+        first = {nt: 0 for nt in self.nonterms}
+        nullable = set()
 
         repeat = True
         while repeat:
             repeat = False
 
             for nt, prod, _, _ in self.productions:
-                curfs = self.__first_sets[nt]
-                curfs_len = len(curfs)
-                curfs.update(self.first_set(prod))
-
-                if len(curfs) > curfs_len:
+                mask, empty = self.__sequence_first(prod, first, nullable)
+                if mask & ~first[nt] or (empty and nt not in nullable):
+                    first[nt] |= mask
+                    if empty:
+                        nullable.add(nt)
                     repeat = True
 
-        self.__first_sets = {x: frozenset(y) for x, y in self.__first_sets.items()}
+        self.__first_sets = {nt: frozenset(self.terminals_of(mask) + ((None,) if nt in nullable else ()))
+                             for nt, mask in first.items()}
+
+        # FIRST of every production suffix and whether it derives the empty
+        # string, as (mask, nullable) for each dot position
+        suffix_first = []
+        for _, prod, _, _ in self.productions:
+            suffixes = [(0, True)]
+            for sym in reversed(prod):
+                mask, empty = suffixes[-1]
+                if isinstance(sym, NonTerminal):
+                    suffixes.append((first[sym] | (mask if sym in nullable else 0),
+                                     empty and sym in nullable))
+                else:
+                    suffixes.append((self.terminal_bits[sym], False))
+            suffix_first.append(tuple(reversed(suffixes)))
+        self.suffix_first = tuple(suffix_first)
 
     def stringify(self, indexes=True):
         lines = '\n'.join(nt.stringify() for nt in self.nonterms)
@@ -721,91 +1649,378 @@ class Parser(object):
     def __str__(self):
         return self.stringify()
 
-    def add_skipped_domain(self, regex):
-        self.skipped_domains.append(regex)
+    def add_skipped_domain(self, regex, *, modes=None, push=None, pop=False):
+        if modes is None and push is None and not pop:
+            self.skipped_domains.append(regex)
+        else:
+            modes = tuple(modes) if modes is not None else None
+            self.skipped_domains.append(SkippedDomain(regex, modes, push, pop))
+
+    def lexer_engine(self):
+        engine = self.__lexer_engine
+        if engine is None or engine.skip != tuple(self.skipped_domains):
+            engine = LexerEngine(self.terminals, self.skipped_domains)
+            self.__lexer_engine = engine
+        return engine
+
+    def byte_lexer_engine(self):
+        # None when the grammar has a pattern or a literal that is not ASCII
+        skip = tuple(self.skipped_domains)
+        if self.__byte_lexer_engine is None or self.__byte_lexer_engine[0] != skip:
+            try:
+                engine = LexerEngine(self.terminals, skip, binary=True)
+            except ValueError:
+                engine = None
+            self.__byte_lexer_engine = skip, engine
+        return self.__byte_lexer_engine[1]
+
+    def make_lexer(self, source, positions=None):
+        positions = positions or self.positions
+        if isinstance(source, TokenBuffer):
+            return source.reader()
+        if isinstance(source, (bytes, mmap.mmap)):
+            # Bytes are lexed as they are if they are ASCII, except for
+            # \x1c-\x1f, which \s of a str pattern matches and of a bytes
+            # pattern does not.  Other text is decoded as UTF-8, and so is
+            # all text when a lexer module is loaded by load_lexer().
+            engine = None
+            if not isinstance(self.lexer_engine(), GeneratedLexerEngine):
+                engine = self.byte_lexer_engine()
+            if engine is not None and NOT_BYTE_LEXABLE.search(source) is None:
+                return self.__profiled(MappedLexer(self.terminals, source, self.skipped_domains,
+                                                   engine=engine,
+                                                   lazy_attributes=self.lazy_attributes))
+            source = str(source, 'utf-8')
+        if not isinstance(source, str):
+            return self.__profiled(StreamLexer(self.terminals, source, self.skipped_domains,
+                                               engine=self.lexer_engine(),
+                                               positions=positions,
+                                               max_token_length=self.max_token_length,
+                                               chunk_size=self.chunk_size))
+        lexer_class = OffsetLexer if positions == 'offsets' else Lexer
+        return self.__profiled(lexer_class(self.terminals, source, self.skipped_domains,
+                                           engine=self.lexer_engine(),
+                                           lazy_attributes=self.lazy_attributes))
+
+    def __profiled(self, lexer):
+        if self.profile_lexer:
+            self.last_lex_stats = LexerStats()
+            lexer.profile(self.last_lex_stats)
+        return lexer
+
+    def parse_file(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return self.parse('')
+            # the mapping stays open while tokens refer to it
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.parse(data)
+
+    def generate_lexer_source(self):
+        engine = self.lexer_engine()
+        if not isinstance(engine, LexerEngine):
+            engine = LexerEngine(self.terminals, self.skipped_domains)
+        return engine.generate_source()
+
+    def load_lexer(self, path):
+        fingerprint = LexerEngine.fingerprint(self.terminals, self.skipped_domains)
+        module = None
+        if os.path.exists(path):
+            module = self.__import_lexer(path)
+        if module is None or getattr(module, 'FINGERPRINT', None) != fingerprint:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.generate_lexer_source())
+            cached = importlib.util.cache_from_source(path)
+            if os.path.exists(cached):
+                os.remove(cached)
+            module = self.__import_lexer(path)
+        self.__lexer_engine = GeneratedLexerEngine(module, self.terminals, self.skipped_domains)
+        return module
+
+    def generate_source(self, path):
+        # A module with the compressed tables and an LR driver over tokens
+        # of this grammar, which neither builds tables nor imports the
+        # grammar.  Folds are imported from where they are defined, unless
+        # that is a module building a grammar; the rest is left to bind().
+        table = self.table.compressed
+        grammar_modules = self.__grammar_modules()
+        imports, folds, unbound, grammar_folds = {}, ['None'], [], set()
+        for rule, (_, _, fold, _) in enumerate(self.productions[1:], 1):
+            function = fold.callee if fold.simple is None else fold.simple
+            if function is NonTerminal._NonTerminal__default_fold:
+                folds.append('_simple(_default_fold)')
+                continue
+            ref = self.__function_reference(function, grammar_modules)
+            if ref is None:
+                folds.append('None')
+                unbound.append(rule)
+                grammar_folds.add(getattr(function, '__module__', None) or '?')
+                continue
+            module, name, attrs = ref
+            alias = imports.setdefault((module, name), '_f%d' % len(imports))
+            ref = alias + ''.join('.' + attr for attr in attrs)
+            folds.append(ref if fold.simple is None else '_simple(%s)' % ref)
+
+        n_terminals = len(self.table.terminals)
+        arrays = [('DEFAULT_REDUCE', table.default_reduce), ('ACTION_BASE', table.action_base),
+                  ('ACTION_CHECK', table.action_check), ('ACTION_NEXT', table.action_next),
+                  ('DEFAULT_GOTO', table.default_goto), ('GOTO_BASE', table.goto_base),
+                  ('GOTO_CHECK', table.goto_check), ('GOTO_NEXT', table.goto_next),
+                  ('RULE_LHS', table.rule_lhs), ('RULE_LENGTH', table.rule_length)]
+        lines = ['# Parser generated by parser_edsl.Parser.generate_source().',
+                 '# Do not edit: generate it again when the grammar changes.']
+        if unbound:
+            # then the module is not standalone: the grammar has to be built
+            lines += ['#',
+                      '# The folds of %d of %d rules are defined where the grammar is built' % (
+                          len(unbound), len(self.productions) - 1),
+                      '# (%s) and are not imported.  Import it and pass the folds to' % (
+                          ', '.join(sorted(grammar_folds))),
+                      '# bind([fold.callee for _, _, fold, _ in parser.productions]).']
+        lines += ['',
+                  'import array',
+                  '']
+        lines += sorted('from %s import %s as %s' % (module, name, alias)
+                        for (module, name), alias in imports.items())
+        lines += ['',
+                  '',
+                  'FINGERPRINT = %r' % self.table_fingerprint(),
+                  'CONTEXT_LEXING = %r' % self.context_lexing,
+                  'TERMINALS = %r' % (tuple(str(terminal) for terminal in self.table.terminals),),
+                  'EXPECTED = %r' % (table.expected,),
+                  'NONASSOC = frozenset(%r)' % sorted(state * n_terminals + t
+                                                     for state, t in table.nonassoc)]
+        lines += ['%s = array.array(%r, %r)' % (name, values.typecode, values.tolist())
+                  for name, values in arrays]
+        lines += [GENERATED_PARSER_FOLDS,
+                  'FOLDS = [']
+        lines += ['    %s,' % fold for fold in folds]
+        lines += [']',
+                  'FOLD_NAMES = %r' % (tuple(getattr(fold.callee, '__name__', '')
+                                             for _, _, fold, _ in self.productions),),
+                  'UNBOUND = %r' % unbound]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n' + GENERATED_PARSER_RUNTIME)
+
+    @staticmethod
+    def __grammar_modules():
+        # importing them would build a grammar, and maybe its tables
+        modules = {'__main__', __name__}
+        for module_name, module in list(sys.modules.items()):
+            values = list(getattr(module, '__dict__', {}).values())
+            if any(isinstance(value, NonTerminal) for value in values):
+                modules.add(module_name)
+        return modules
+
+    @staticmethod
+    def __function_reference(function, grammar_modules):
+        # (module, global name, attribute path) by which function is found
+        module = getattr(function, '__module__', None)
+        qualname = getattr(function, '__qualname__', '')
+        if module in grammar_modules or module not in sys.modules or '<' in qualname:
+            return None
+        name, *attrs = qualname.split('.')
+        value = sys.modules[module]
+        for attr in [name] + attrs:
+            value = getattr(value, attr, None)
+        if value != function:
+            return None
+        return module, name, attrs
+
+    @staticmethod
+    def __import_lexer(path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(module)
+        except (ImportError, SyntaxError):
+            return None
+        return module
+
+    def tokenize_buffer(self, source):
+        lexer = self.make_lexer(source, positions='offsets')
+        return lexer.fill(TokenBuffer(self.terminals, lexer.index, lexer.text))
+
+    def add_chunk_boundary(self, regex):
+        self.chunk_boundaries.append(regex)
+
+    def tokenize_parallel(self, text, workers=None):
+        workers = workers or os.cpu_count() or 1
+        bounds = self.__chunk_bounds(text, min(workers * 4, len(text) // self.chunk_size))
+        engine = self.lexer_engine()
+        if workers < 2 or len(bounds) < 2 or engine.transitions \
+                or 'fork' not in multiprocessing.get_all_start_methods():
+            return self.tokenize_buffer(text)
+
+        global PARALLEL_INPUT
+        lexer = OffsetLexer(self.terminals, text, self.skipped_domains, engine=engine,
+                            lazy_attributes=self.lazy_attributes)
+        buffer = TokenBuffer(self.terminals, lexer.index, lexer.text)
+        PARALLEL_INPUT = engine, text
+        try:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                # A chunk is only taken as is when the lexer really arrives
+                # at its start and its last token ends at its end; the rest
+                # is lexed sequentially from wherever the lexer stopped.
+                for (start, end), spans in zip(bounds, pool.imap(lex_chunk, bounds)):
+                    if lexer.offset == start and spans is not None:
+                        lexer.append_spans(buffer, *spans)
+                        lexer.offset = buffer.end = end
+                    elif lexer.offset < end:
+                        lexer.fill(buffer, stop=end)
+        finally:
+            PARALLEL_INPUT = None
+        return buffer
+
+    def __chunk_bounds(self, text, count):
+        if count < 2 or not self.chunk_boundaries:
+            return [(0, len(text))]
+        boundary = re.compile('|'.join('(?:%s)' % regex for regex in self.chunk_boundaries),
+                              re.MULTILINE)
+        splits = [0]
+        for k in range(1, count):
+            m = boundary.search(text, max(len(text) * k // count, splits[-1]))
+            if m is None:
+                break
+            if splits[-1] < m.end() < len(text):
+                splits.append(m.end())
+        splits.append(len(text))
+        return list(zip(splits, splits[1:]))
+
+    def expected_terminals(self):
+        # terminal numbers with a non-empty action, for every LR state
+        if self.__expected_terminals is None:
+            ids = {terminal: i for i, terminal in enumerate(self.terminals)}
+            self.__expected_terminals = tuple(
+                frozenset(ids[symbol] for symbol, actions in row.items()
+                          if len(actions) > 0 and symbol in ids)
+                for row in self.table.action)
+        return self.__expected_terminals
 
     def parse(self, text):
-        lexer = Lexer(self.terminals, text, self.skipped_domains)
+        lexer = self.make_lexer(text)
+        if self.pipelined and not self.context_lexing:
+            lexer = PipelinedLexer(lexer)
+            try:
+                return self.__parse(lexer)
+            finally:
+                lexer.close()
+        return self.__parse(lexer)
+
+    def __token_reader(self, lexer):
+        if isinstance(lexer, TokenBufferReader):
+            # already lexed: there is no lexer error, nor a lexer to restrict
+            return lexer.next_token
+        expected = self.expected_terminals() if self.context_lexing else None
+
+        def next_token(state):
+            try:
+                if expected is None:
+                    return lexer.next_token()
+                return lexer.next_token(expected[state])
+            except LexerError as lex_err:
+                raise ParseError(pos=lex_err.pos, unexpected=lex_err, expected=[], _text=lex_err.message) from lex_err
+
+        return next_token
+
+    def __syntax_error(self, state, cur):
+        table = self.table.compressed
+        if (state, table.terminal_ids[cur.type]) in table.nonassoc:
+            return ParseError(pos=cur.pos.start, unexpected=cur, expected=[cur.type], _text="Неассоциативная операция")
+        expected = [symbol for symbol, i in table.terminal_ids.items()
+                    if table.expected[state] >> i & 1]
+        return ParseError(pos=cur.pos.start, unexpected=cur, expected=expected)
+
+    def __parse(self, lexer):
+        next_token = self.__token_reader(lexer)
+        table = self.table.compressed
+        terminal_ids = table.terminal_ids
+        action_base, action_check, action_next = table.action_base, table.action_check, table.action_next
+        default_reduce, expected_terminals = table.default_reduce, table.expected
+        rule_lhs, rule_length = table.rule_lhs, table.rule_length
+
         stack = [(0, Fragment(Position(), Position()), None)]
-        try:
-            cur = lexer.next_token()
-        except LexerError as lex_err:
-            raise ParseError(pos=lex_err.pos, unexpected=lex_err, expected=[], _text=lex_err.message) from lex_err
+        cur = next_token(0)
+        t = terminal_ids[cur.type]
 
         while True:
             cur_state, cur_coord, top_attr = stack[-1]
-            actions = self.table.action[cur_state][cur.type]
-            if len(actions) < 2:
-                action = next(iter(actions), None)
-            elif len(actions) == 2:
-                # Shift/reduce conflict: resolve via precedence
-                shift_action = None
-                reduce_action = None
-                for act in actions:
-                    if isinstance(act, Shift):
-                        shift_action = act
-                    elif isinstance(act, Reduce):
-                        reduce_action = act
-                if shift_action is not None and reduce_action is not None:
-                    _, _, fold, prod_prec = self.productions[reduce_action.rule]
-                    if prod_prec is None:
-                        prod = self.productions[reduce_action.rule][1]
-                        for sym in reversed(prod):
-                            if isinstance(sym, BaseTerminal):
-                                prod_prec = Precedence(sym.priority, 'left')
-                                break
-                    token_prec = cur.type.priority
-                    if prod_prec is None:
-                        action = shift_action
-                    elif token_prec > prod_prec.level:
-                        action = shift_action
-                    elif token_prec < prod_prec.level:
-                        action = reduce_action
-                    else:
-                        if prod_prec.associativity == 'left':
-                            action = reduce_action
-                        elif prod_prec.associativity == 'right':
-                            action = shift_action
-                        else:
-                            raise ParseError(pos=cur.pos.start, unexpected=cur, expected=[cur.type], _text="Неассоциативная операция")
+            index = action_base[cur_state] + t
+            if action_check[index] == cur_state:
+                action = action_next[index]
+            elif expected_terminals[cur_state] >> t & 1:
+                action = default_reduce[cur_state]
+            else:
+                action = table.ERROR
+
+            if action > 0:
+                state = action - 1
+                stack.append((state, cur.pos, cur.attr))
+                cur = next_token(state)
+                t = terminal_ids[cur.type]
+            elif action < -1:
+                rule = -action - 1
+                _, _, fold, _ = self.productions[rule]
+                n = rule_length[rule]
+                attrs = [attr for state, coord, attr in stack[len(stack)-n:]
+                         if attr != None]
+                if self.lazy_attributes:
+                    attrs = self.__resolve_attributes(attrs)
+                coords = [coord for state, coord, attr in stack[len(stack)-n:]]
+                if len(coords) > 0:
+                    res_coord = coords[0].join(coords[-1])
                 else:
-                    action = shift_action or reduce_action
-
-            match action:
-                case Shift(state):
-                    stack.append((state, cur.pos, cur.attr))
-                    try:
-                        cur = lexer.next_token()
-                    except LexerError as lex_err:
-                        raise ParseError(pos=lex_err.pos, unexpected=lex_err, expected=[], _text=lex_err.message) from lex_err
-
-                case Reduce(rule):
-                    nt, prod, fold, _ = self.productions[rule]
-                    n = len(prod)
-                    attrs = [attr for state, coord, attr in stack[len(stack)-n:]
-                             if attr != None]
-                    coords = [coord for state, coord, attr in stack[len(stack)-n:]]
-                    if len(coords) > 0:
-                        res_coord = Fragment(coords[0].start, coords[-1].following)
-                    else:
-                        res_coord = Fragment(cur.pos.start, cur.pos.start)
-                    del stack[len(stack)-n:]
-                    goto_state = self.table.goto[stack[-1][0]][nt]
-                    res_attr = fold.callee(attrs, coords, res_coord)
-                    stack.append((goto_state, res_coord, res_attr))
-                case Accept():
-                    assert(len(stack) == 2)
-                    return top_attr
-                case None:
-                    expected = [symbol for symbol, actions
-                                in self.table.action[cur_state].items()
-                                if len(actions) > 0]
-                    raise ParseError(pos=cur.pos.start, unexpected=cur,
-                                     expected=expected)
+                    res_coord = cur.pos.at_start()
+                del stack[len(stack)-n:]
+                goto_state = table.goto(stack[-1][0], rule_lhs[rule])
+                res_attr = fold.callee(attrs, coords, res_coord)
+                stack.append((goto_state, res_coord, res_attr))
+            elif action == -1:
+                assert(len(stack) == 2)
+                return top_attr
+            else:
+                raise self.__syntax_error(cur_state, cur)
+
+    # frames left to folds and the lexer below the deepest ascent call
+    ASCENT_RESERVE = 200
+
+    def parse_ascent(self, text):
+        # The same parse by the recursive ascent code of the tables.  Its
+        # stack is the Python call stack: when it would come close to the
+        # recursion limit, the text is parsed again by parse().
+        if not isinstance(text, (str, bytes, mmap.mmap, TokenBuffer)):
+            raise ValueError('Recursive ascent needs text, bytes or a TokenBuffer')
+        if self.__ascent is None:
+            self.__ascent = RecursiveAscent(self, self.__syntax_error)
+        depth, frame = 0, sys._getframe()
+        while frame is not None:
+            depth, frame = depth + 1, frame.f_back
+        lexer = self.make_lexer(text)
+        start, values = self.__ascent.make_parser(self.__token_reader(lexer),
+                                                  self.table.compressed.terminal_ids,
+                                                  self.lazy_attributes, self.__resolve_attributes,
+                                                  sys.getrecursionlimit() - depth - self.ASCENT_RESERVE)
+        try:
+            start()
+        except RecursiveAscent.TooDeep:
+            return self.__parse(self.make_lexer(text))
+        return values[-1]
+
+    @staticmethod
+    def __resolve_attributes(attrs):
+        try:
+            attrs = [resolve_attribute(attr) for attr in attrs]
+        except LexerError as lex_err:
+            raise ParseError(pos=lex_err.pos, unexpected=lex_err, expected=[], _text=lex_err.message) from lex_err
+        return [attr for attr in attrs if attr != None]
 
     def parse_earley(self, text):
-        tokens = list(self.tokenize(text))
-        tokens = [token for token in tokens if token.type != EOF_SYMBOL]
+        if isinstance(text, TokenBuffer):
+            tokens = text
+        else:
+            tokens = list(self.tokenize(text))
+            tokens = [token for token in tokens if token.type != EOF_SYMBOL]
         earley_parser = EarleyParser(self)
         res = earley_parser.parse(tokens)
 
@@ -815,7 +2030,7 @@ class Parser(object):
         if not self.is_ll1():
             raise ValueError("Grammar is not LL(1); cannot parse in LL(1) mode.")
 
-        lexer = Lexer(self.terminals, text, self.skipped_domains)
+        lexer = self.make_lexer(text)
 
         start_nt = self.nonterms[0]
         root = ParseTreeNode(symbol=start_nt, fold=None)
@@ -873,6 +2088,7 @@ class Parser(object):
         except PredictiveTableConflictError:
             self.ll1_is_ok = False
             raise
+        self.__write_table_cache()
 
     def is_ll1(self):
         if self.ll1_table is None and self.ll1_is_ok:
@@ -889,7 +2105,7 @@ class Parser(object):
 
     def _evaluate_parse_tree(self, node: ParseTreeNode):
         if isinstance(node.symbol, BaseTerminal):
-            node.attribute = node.token.attr if node.token else None
+            node.attribute = resolve_attribute(node.token.attr) if node.token else None
             return node.attribute
 
         for child in node.children:
@@ -898,7 +2114,7 @@ class Parser(object):
 
         coords = [child.token.pos for child in node.children if child.token is not None]
         if len(coords) > 0:
-            res_coord = Fragment(coords[0].start, coords[-1].following)
+            res_coord = coords[0].join(coords[-1])
         else:
             if node.children:
                 coords_for_start = [c for c in node.children if c.token is not None]
@@ -922,7 +2138,7 @@ class Parser(object):
         return node.attribute
 
     def tokenize(self, text):
-        lexer = Lexer(self.terminals, text, self.skipped_domains)
+        lexer = self.make_lexer(text)
 
         while True:
             token = lexer.next_token()
@@ -937,29 +2153,6 @@ class Parser(object):
         print(self.table.stringify(), file=file)
 
 
-def goto(gr, item_set, inp):
-    result_set = set()
-    for (item, lookahead) in item_set:
-        prod_id, dot = item
-        _, pbody, _, _ = gr.productions[prod_id]
-        if dot == len(pbody) or pbody[dot] != inp:
-            continue
-
-        new_item = ((prod_id, dot + 1), lookahead)
-        result_set.add(new_item)
-
-    result_set = closure(gr, result_set)
-    return result_set
-
-
-def kernels(item_set):
-    return frozenset((item, nextsym) for item, nextsym in item_set if item[1] > 0 or item[0] == 0)
-
-
-def drop_itemset_lookaheads(itemset):
-    return frozenset((x[0], x[1]) for x, y in itemset)
-
-
 def describe_grammar(gr):
     return '\n'.join([
         'Grammar rules (%d in total):' % len(gr.productions),
@@ -1001,63 +2194,55 @@ class LR0_Automaton:
         self.states = []
         self.id_from_state = dict()
         self.goto = dict()
-
-        self.states = [LR0_Automaton.__closure(gr, [(0, 0)])]
-        next_id = 0
-
-        self.id_from_state[self.states[-1]] = next_id
-        next_id += 1
-
-        seen = set(self.states)
-        set_queue = self.states
-        while len(set_queue) > 0:
-            new_elements = []
-            for item_set in set_queue:
-                item_set_id = self.id_from_state[item_set]
-                for symbol in gr.symbols:
-                    next_item_set = LR0_Automaton.__goto(gr, item_set, symbol)
-                    if len(next_item_set) == 0:
-                        continue
-                    if next_item_set not in seen:
-                        new_elements += [next_item_set]
-                        seen.add(next_item_set)
-                        self.states += [next_item_set]
-                        self.id_from_state[self.states[-1]] = next_id
-                        next_id += 1
-                    self.goto[(item_set_id, symbol)] = self.id_from_state[next_item_set]
-            set_queue = new_elements
-
-    @staticmethod
-    def __closure(gr, item_set):
+        # the items B -> . w that a nonterminal after the dot brings in
+        self.__start_items = {}
+
+        self.states = [self.__closure(gr, [(0, 0)])]
+        self.id_from_state[self.states[0]] = 0
+
+        # A state only moves on the symbols after its dots: its items are
+        # grouped by that symbol, and the groups are taken in the order of
+        # gr.symbols, so states are numbered as if every symbol were tried.
+        order = {symbol: i for i, symbol in enumerate(gr.symbols)}
+        for item_set_id, item_set in enumerate(self.states):
+            moves = {}
+            for prod_index, dot in item_set:
+                pbody = gr.productions[prod_index][1]
+                if dot < len(pbody):
+                    moves.setdefault(pbody[dot], []).append((prod_index, dot + 1))
+            for symbol in sorted(moves, key=order.__getitem__):
+                next_item_set = self.__closure(gr, moves[symbol])
+                next_id = self.id_from_state.get(next_item_set)
+                if next_id is None:
+                    next_id = self.id_from_state[next_item_set] = len(self.states)
+                    self.states.append(next_item_set)
+                self.goto[(item_set_id, symbol)] = next_id
+
+    def __closure(self, gr, item_set):
         result = set(item_set)
-        set_queue = item_set
-        while len(set_queue) > 0:
-            new_elements = []
-            for itemProdId, dot in set_queue:
-                _, pbody, _, _ = gr.productions[itemProdId]
-                if dot == len(pbody) or pbody[dot] not in gr.nonterms:
-                    continue
-                nt = pbody[dot]
-                nt_offset = gr.nonterm_offset[nt]
-                for idx in range(len(nt.productions)):
-                    new_item_set = (nt_offset + idx, 0)
-                    if new_item_set not in result:
-                        new_elements += [new_item_set]
-                        result.add(new_item_set)
-            set_queue = new_elements
-        return frozenset(result)
-
-
-    @staticmethod
-    def __goto(gr, item_set, inp):
-        result_set = set()
         for prod_index, dot in item_set:
-            _, pbody, _, _ = gr.productions[prod_index]
-            if dot < len(pbody) and pbody[dot] == inp:
-                result_set.add((prod_index, dot + 1))
-        result_set = LR0_Automaton.__closure(gr, result_set)
-        return result_set
+            pbody = gr.productions[prod_index][1]
+            if dot < len(pbody) and isinstance(pbody[dot], NonTerminal):
+                result |= self.__starts(gr, pbody[dot])
+        return frozenset(result)
 
+    def __starts(self, gr, nt):
+        items = self.__start_items.get(nt)
+        if items is None:
+            items = set()
+            seen = {nt}
+            queue = [nt]
+            while queue:
+                current = queue.pop()
+                offset = gr.nonterm_offset[current]
+                for idx in range(len(current.productions)):
+                    items.add((offset + idx, 0))
+                    pbody = gr.productions[offset + idx][1]
+                    if pbody and isinstance(pbody[0], NonTerminal) and pbody[0] not in seen:
+                        seen.add(pbody[0])
+                        queue.append(pbody[0])
+            items = self.__start_items[nt] = frozenset(items)
+        return items
 
     @staticmethod
     def __kernels(item_set):
@@ -1070,9 +2255,10 @@ class LR0_Automaton:
 class LexerError(Error):
     ERROR_SLICE = 10
 
-    def __init__(self, pos, text, message=""):
+    def __init__(self, pos, text, message="", offset=None):
         self.pos = pos
-        self.bad = text[pos.offset:pos.offset + self.ERROR_SLICE]
+        offset = pos.offset if offset is None else offset
+        self.bad = text[offset:offset + self.ERROR_SLICE]
         self._message = f'Не удалось разобрать {self.bad!r}' if message == "" else message
 
     def __repr__(self):
@@ -1083,38 +2269,1519 @@ class LexerError(Error):
         return self._message
 
 
-class Lexer:
-    def __init__(self, domains, text, skip):
+SkippedDomain = collections.namedtuple('SkippedDomain', 'regex modes push pop')
+
+
+def skipped_domain_terminal(skip):
+    if isinstance(skip, SkippedDomain):
+        return Terminal('-skip-', skip.regex, None,
+                        modes=skip.modes, push=skip.push, pop=skip.pop)
+    return Terminal('-skip-', skip, None)
+
+
+class BaseLexerEngine:
+    binary = False
+
+    def for_mode(self, mode):
+        engine = self.engines.get(mode)
+        if engine is None:
+            engine = LexerEngine(self.domains[:self.n_terminals], self.skip, mode, self.engines,
+                                 binary=self.binary)
+        return engine
+
+    def restricted(self, terminals):
+        engine = self.engines.get((self.mode, terminals))
+        if engine is None:
+            engine = LexerEngine(self.domains[:self.n_terminals], self.skip, self.mode,
+                                 self.engines, terminals, binary=self.binary)
+        return engine
+
+    def is_skip(self, index):
+        return index >= self.n_terminals
+
+    def is_run(self, index):
+        return index >= self.n_terminals + len(self.skip)
+
+    # For every domain, a regex of the text from the start of its match to
+    # the farthest character the match may look at, and how far that may
+    # be, None if unbounded.  The match only looks on while it takes every
+    # character, but for those its lookahead assertions look at past the
+    # last one taken, so a scan that meets other characters never gets to
+    # the end of the text the regex matches.
+    reach = None
+
+    def may_look_at(self, text, start, offset):
+        if self.reach is None:
+            self.reach = [self.__reach(domain) for domain in self.domains]
+        for run, width in self.reach:
+            if width is not None and offset - start > width:
+                continue
+            if run is None or run.fullmatch(text, start, offset) is not None:
+                return True
+        return False
+
+    @classmethod
+    def __reach(cls, domain):
+        if isinstance(domain, LiteralTerminal):
+            chars = sorted(set(domain.image))
+            return re.compile('[%s]*' % ''.join(map(re.escape, chars))), len(domain.image)
+        try:
+            parsed = sre_parse.parse(domain.re.pattern, domain.re.flags)
+        except Exception:
+            return None, None
+        taken, looked = set(), set()
+        look_width = cls.__alphabet(parsed, taken, looked)
+        if look_width is None:
+            return None, None
+        run = '(?:%s)*' % '|'.join(sorted(taken)) if taken else ''
+        if looked:
+            repeat = '*' if look_width >= sre_constants.MAXREPEAT else '{0,%d}' % look_width
+            run += '(?:%s)%s' % ('|'.join(sorted(looked)), repeat)
+        width = parsed.getwidth()[1]
+        if looked or width >= sre_constants.MAXREPEAT:
+            width = None
+        return re.compile(run, domain.re.flags & (re.IGNORECASE | re.ASCII)), width
+
+    @classmethod
+    def __alphabet(cls, items, taken, looked):
+        # Adds the characters items take to taken and the ones their
+        # lookahead assertions look at to looked, as regexes of one
+        # character each.  Returns how far the assertions may look, None
+        # if some characters are not known.
+        c = sre_constants
+        look_width = 0
+        for op, av in items:
+            subpatterns = ()
+            if op is c.LITERAL:
+                taken.add(re.escape(chr(av)))
+            elif op is c.NOT_LITERAL:
+                taken.add('[^%s]' % re.escape(chr(av)))
+            elif op is c.ANY:
+                taken.add('(?s:.)')
+            elif op is c.IN:
+                piece = cls.__char_class(av)
+                if piece is None:
+                    return None
+                taken.add(piece)
+            elif op in (c.AT, c.GROUPREF):
+                pass
+            elif op in (c.ASSERT, c.ASSERT_NOT):
+                direction, pattern = av
+                if direction > 0:
+                    # what it takes is only looked at
+                    if cls.__alphabet(pattern, looked, looked) is None:
+                        return None
+                    look_width = max(look_width, pattern.getwidth()[1])
+            elif op is c.SUBPATTERN:
+                subpatterns = [av[3]]
+            elif op is c.BRANCH:
+                subpatterns = av[1]
+            elif op in (c.MAX_REPEAT, c.MIN_REPEAT, getattr(c, 'POSSESSIVE_REPEAT', None)):
+                subpatterns = [av[2]]
+            elif op is getattr(c, 'ATOMIC_GROUP', None):
+                subpatterns = [av]
+            elif op is c.GROUPREF_EXISTS:
+                subpatterns = [branch for branch in av[1:] if branch is not None]
+            else:
+                return None
+            for pattern in subpatterns:
+                width = cls.__alphabet(pattern, taken, looked)
+                if width is None:
+                    return None
+                look_width = max(look_width, width)
+        return look_width
+
+    @staticmethod
+    def __char_class(items):
+        c = sre_constants
+        negate = ''
+        chars = []
+        for op, av in items:
+            if op is c.NEGATE:
+                negate = '^'
+            elif op is c.LITERAL:
+                chars.append(re.escape(chr(av)))
+            elif op is c.RANGE:
+                chars.append('%s-%s' % (re.escape(chr(av[0])), re.escape(chr(av[1]))))
+            elif op is c.CATEGORY and av in LexerEngine.CATEGORY_ESCAPES:
+                chars.append(LexerEngine.CATEGORY_ESCAPES[av])
+            else:
+                return None
+        return '[%s%s]' % (negate, ''.join(chars))
+
+
+class LexerEngine(BaseLexerEngine):
+    FLAG_LETTERS = {
+        re.IGNORECASE: 'i',
+        re.MULTILINE: 'm',
+        re.DOTALL: 's',
+        re.VERBOSE: 'x',
+        re.ASCII: 'a',
+    }
+
+    def __init__(self, domains, skip, mode=INITIAL_MODE, engines=None, terminals=None,
+                 binary=False):
+        self.skip = tuple(skip)
         self.domains = list(domains)
+        self.n_terminals = len(self.domains)
+        if engines:
+            # shared, so that a skipped domain is one object for profiling
+            other = next(iter(engines.values()))
+            self.domains += other.domains[self.n_terminals:self.n_terminals + len(self.skip)]
+        else:
+            self.domains += [skipped_domain_terminal(regex) for regex in self.skip]
+
+        # A binary engine matches bytes-compiled patterns over bytes-like
+        # text; it is only built for grammars whose patterns and literals
+        # are all ASCII, and gives the same tokens as the str engine on
+        # text that is ASCII too.
+        self.binary = binary
+        self.regexes = [getattr(domain, 're', None) for domain in self.domains]
+        if binary:
+            for i, domain in enumerate(self.domains):
+                if isinstance(domain, LiteralTerminal):
+                    self.__encode(domain.image)
+                else:
+                    self.regexes[i] = self.__compile(domain.regex, domain.re.flags)
+
+        # Each lexer mode has its own engine over the domains active in it,
+        # and so has every set of terminals the parser may restrict it to;
+        # the engines of one grammar share the domain numbering.
+        self.mode = mode
+        self.engines = engines if engines is not None else {}
+        self.engines[mode if terminals is None else (mode, terminals)] = self
+        self.transitions = self.mode_transitions(self.domains, mode)
+
+        # Every regex domain becomes an optional lookahead group of one master
+        # pattern, so a single re.match reports the match length of all of
+        # them at once.  Groups are ordered by priority, then by position in
+        # the domain list, hence the first longest span is the winner.
+        # Literals go to a prefix trie instead: one walk finds the longest.
+        in_mode = [i for i, domain in enumerate(self.domains)
+                   if mode in getattr(domain, 'modes', (INITIAL_MODE,))]
+        active = [i for i in in_mode
+                  if terminals is None or i in terminals or self.is_skip(i)]
+        # An expected keyword is still matched as its identifier and looked
+        # up, or it would match the prefix of a longer word; a word that is
+        # not a keyword then comes back as an unexpected identifier.
+        # Keywords stay reserved where the parser does not expect them.
+        if terminals is not None:
+            ids = {domain: i for i, domain in enumerate(self.domains[:self.n_terminals])}
+            active = sorted(set(active) | {ids[self.domains[i].identifier] for i in active
+                                           if isinstance(self.domains[i], KeywordTerminal)
+                                           and self.domains[i].identifier in ids})
+        self.keywords = self.__keyword_tables(active, in_mode)
+        replaced = {k for table in self.keywords.values() for k in table.values()}
+        active = [i for i in active if i not in replaced]
+        self.order = sorted(active, key=lambda i: (-self.domains[i].priority, i))
+        self.pieces = {}
+        self.literals = {}
+        for i in self.order:
+            if isinstance(self.domains[i], LiteralTerminal):
+                self.__add_literal(i, self.domains[i].image)
+            else:
+                self.pieces[i] = self.__combinable_regex(self.domains[i])
+
+        # A regex domain is only tried at characters its match can start
+        # with.  Every ASCII character is mapped to the master pattern built
+        # from its candidates; the others use the full one.
+        self.full = self.__scanner(self.pieces.keys())
+        self.scanners = {}
+        masks = [0] * 128
+        firsts = {}
+        for i in self.pieces:
+            firsts[i] = first = self.__first_chars(self.domains[i].re)
+            for code in range(128) if first is None else first:
+                masks[code] |= 1 << i
+        self.dispatch = [self.__scanner_for_mask(mask) for mask in masks]
+
+        # Single-character skipped domains that no other domain can start
+        # with are consumed as maximal runs in one step, as a separate
+        # skipped domain.
+        self.run_index = None
+        runs = self.__run_domains(firsts)
+        if runs:
+            self.run_index = len(self.domains)
+            pieces = '|'.join(self.pieces[i] for i in runs)
+            run = Terminal('-skip-', '(?:(?=[\\x00-\\x7f])(?:%s))*' % pieces, None, re_flags=0)
+            # the skipped domains it consumes, profiling reports it as them
+            run.sources = tuple(self.domains[i] for i in runs)
+            self.domains.append(run)
+            scanner = (self.__compile(run.regex).match, lambda regs: regs[:1], (self.run_index,), ())
+            for i in runs:
+                for code in firsts[i]:
+                    self.dispatch[code] = scanner
+
+        # match() looks the scanner up by the item of the text it starts at:
+        # a character of a str, an integer of bytes
+        self.first_char = {code if binary else chr(code): scanner
+                           for code, scanner in enumerate(self.dispatch)}
+
+    def __keyword_tables(self, active, in_mode):
+        ids = {self.domains[i]: i for i in active if i < self.n_terminals}
+        keywords = {}
+        for i in in_mode:
+            domain = self.domains[i]
+            if isinstance(domain, KeywordTerminal) and domain.identifier in ids \
+                    and not domain.identifier.re.flags & re.IGNORECASE:
+                image = self.__encode(domain.name) if self.binary else domain.name
+                keywords.setdefault(ids[domain.identifier], {}).setdefault(image, i)
+        return keywords
+
+    @staticmethod
+    def mode_transitions(domains, mode):
+        return {i: (domain.push, domain.pop) for i, domain in enumerate(domains)
+                if mode in getattr(domain, 'modes', (INITIAL_MODE,))
+                and (getattr(domain, 'push', None) is not None or getattr(domain, 'pop', False))}
+
+    def __run_domains(self, firsts):
+        runs = set()
+        for i in range(self.n_terminals, len(self.domains)):
+            if i in self.transitions:
+                continue
+            if firsts.get(i) is not None and self.pieces[i] is not None \
+                    and sre_parse.parse(self.domains[i].regex, self.domains[i].re.flags).getwidth() == (1, 1):
+                runs.add(i)
+
+        taken = {char if self.binary else ord(char) for char in self.literals}
+        changed = True
+        while changed:
+            changed = False
+            others = set(taken)
+            for i, first in firsts.items():
+                if i not in runs:
+                    others |= set(range(128)) if first is None else first
+            for i in list(runs):
+                if firsts[i] & others:
+                    runs.discard(i)
+                    changed = True
+        return sorted(runs)
+
+    def __scanner_for_mask(self, mask):
+        if mask not in self.scanners:
+            self.scanners[mask] = self.__scanner(i for i in self.pieces if mask >> i & 1)
+        return self.scanners[mask]
+
+    def __scanner(self, candidates):
+        pieces = []
+        combined = []
+        separate = []
+        for i in candidates:
+            if self.pieces[i] is None:
+                separate.append(i)
+            else:
+                pieces.append('(?:(?=(?P<_%d>%s)))?' % (i, self.pieces[i]))
+                combined.append(i)
+
+        master = self.__compile(''.join(pieces))
+        groups = [master.groupindex['_%d' % i] for i in combined]
+        if groups:
+            spans = operator.itemgetter(*groups, 0)
+        else:
+            spans = lambda regs: (regs[0],)
+        return master.match, spans, tuple(combined), tuple(separate)
+
+    CATEGORY_ESCAPES = {
+        sre_constants.CATEGORY_DIGIT: r'\d',
+        sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+        sre_constants.CATEGORY_SPACE: r'\s',
+        sre_constants.CATEGORY_NOT_SPACE: r'\S',
+        sre_constants.CATEGORY_WORD: r'\w',
+        sre_constants.CATEGORY_NOT_WORD: r'\W',
+    }
+
+    @classmethod
+    def __first_chars(cls, compiled):
+        # ASCII codes a non-empty match may start with, None if unknown
+        try:
+            parsed = sre_parse.parse(compiled.pattern, compiled.flags)
+        except Exception:
+            return None
+        first, nullable = cls.__first_of_sequence(parsed, compiled.flags)
+        return first
+
+    @classmethod
+    def __first_of_sequence(cls, items, flags):
+        result = set()
+        for op, av in items:
+            first, nullable = cls.__first_of_item(op, av, flags)
+            if first is None:
+                return None, False
+            result |= first
+            if not nullable:
+                return result, False
+        return result, True
+
+    @classmethod
+    def __first_of_item(cls, op, av, flags):
+        c = sre_constants
+        if op in (c.AT, c.ASSERT, c.ASSERT_NOT):
+            return set(), True
+        if op is c.LITERAL:
+            return cls.__chars_with_case({av}, flags), False
+        if op is c.IN:
+            return cls.__first_of_set(av, flags), False
+        if op is c.SUBPATTERN:
+            group, add_flags, del_flags, pattern = av
+            return cls.__first_of_sequence(pattern, (flags | add_flags) & ~del_flags)
+        if op is c.BRANCH:
+            result, nullable = set(), False
+            for branch in av[1]:
+                first, branch_nullable = cls.__first_of_sequence(branch, flags)
+                if first is None:
+                    return None, False
+                result |= first
+                nullable = nullable or branch_nullable
+            return result, nullable
+        if op is getattr(c, 'ATOMIC_GROUP', None):
+            return cls.__first_of_sequence(av, flags)
+        if op in (c.MAX_REPEAT, c.MIN_REPEAT, getattr(c, 'POSSESSIVE_REPEAT', None)):
+            low, high, pattern = av
+            first, nullable = cls.__first_of_sequence(pattern, flags)
+            return first, nullable or low == 0
+        return None, False
+
+    @classmethod
+    def __first_of_set(cls, items, flags):
+        c = sre_constants
+        result = set()
+        for op, av in items:
+            if op is c.LITERAL:
+                result.add(av)
+            elif op is c.RANGE:
+                low, high = av
+                if high >= 128 and flags & re.IGNORECASE:
+                    return None
+                result.update(range(low, min(high, 127) + 1))
+            elif op is c.CATEGORY and av in cls.CATEGORY_ESCAPES:
+                category = re.compile(cls.CATEGORY_ESCAPES[av], flags & re.ASCII)
+                result.update(code for code in range(128) if category.match(chr(code)))
+            else:
+                return None
+        return cls.__chars_with_case(result, flags)
+
+    @staticmethod
+    def __chars_with_case(codes, flags):
+        if not flags & re.IGNORECASE:
+            return {code for code in codes if code < 128}
+        if any(code >= 128 for code in codes):
+            return None
+        chars = {chr(code) for code in codes}
+        chars |= {char.lower() for char in chars} | {char.upper() for char in chars}
+        return {ord(char) for char in chars}
+
+    GENERATOR_VERSION = 1
+
+    @classmethod
+    def fingerprint(cls, domains, skip):
+        signature = [cls.GENERATOR_VERSION]
+        for domain in domains:
+            if isinstance(domain, Terminal):
+                signature.append(('regex', domain.name, domain.regex, domain.re.flags, domain.priority,
+                                  tuple(sorted(domain.modes)), domain.push, domain.pop,
+                                  str(getattr(domain, 'identifier', '')), domain.intern))
+            elif isinstance(domain, LiteralTerminal):
+                signature.append(('literal', domain.image, domain.priority))
+            else:
+                signature.append((type(domain).__name__, str(domain)))
+        signature.append(('skip', tuple(skip)))
+        return hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+
+    def generate_source(self):
+        n = self.n_terminals
+        refs, imports, unbound = [], [], []
+        for i, domain in enumerate(self.domains[:n]):
+            func = getattr(domain, 'func', None) if isinstance(domain, Terminal) else None
+            ref = self.__function_reference(func, i) if func is not None else ('None', None)
+            if ref is None:
+                refs.append('None')
+                unbound.append(i)
+            else:
+                refs.append(ref[0])
+                if ref[1] is not None:
+                    imports.append(ref[1])
+
+        # Every ASCII character gets its own matcher function, specialised
+        # when a single regex, a literal or the skipped run can start there.
+        matchers = {}
+        dispatch = []
+        scanners = {id(self.full): (0, self.full)}
+        for code, scanner in enumerate(self.dispatch):
+            source = self.__character_matcher(chr(code), scanner)
+            if source is None:
+                scanners.setdefault(id(scanner), (len(scanners), scanner))
+                source = '    return _general(_S%d, text, offset)\n' % scanners[id(scanner)][0]
+            dispatch.append(matchers.setdefault(source, '_m%d' % len(matchers)))
+        names = {key: '_S%d' % k for key, (k, scanner) in scanners.items()}
+
+        lines = ['# Lexer generated by parser_edsl.Parser.generate_lexer_source().',
+                 '# Do not edit: the file is rewritten when the grammar changes.',
+                 '',
+                 'import operator',
+                 'import re',
+                 'import sys']
+        lines += sorted(set(imports))
+        lines += ['',
+                  '',
+                  'FINGERPRINT = %r' % self.fingerprint(self.domains[:n], self.skip),
+                  'NAMES = %r' % (tuple(str(domain) for domain in self.domains[:n]),),
+                  'N_TERMINALS = %d' % n,
+                  'RUN_INDEX = %r' % self.run_index,
+                  'RUN_PATTERN = %r' % (self.domains[self.run_index].regex
+                                        if self.run_index is not None else None),
+                  'ERROR_PRIORITY = %r' % ErrorTerminal.priority,
+                  'PRIORITIES = %r' % (tuple(domain.priority for domain in self.domains),),
+                  'FUNCS = [%s]' % ', '.join(refs),
+                  'UNBOUND = %r' % unbound,
+                  'INTERN = %r' % (frozenset(i for i, domain in enumerate(self.domains[:n])
+                                             if getattr(domain, 'intern', False)),),
+                  'LITERALS = %r' % self.literals,
+                  'TRANSITIONS = %r' % self.transitions,
+                  'KEYWORDS = %r' % self.keywords,
+                  '_MATCH = {']
+        for i in sorted(self.pieces):
+            regex = self.domains[i].re
+            lines.append('    %d: re.compile(%r, %d).match,' % (i, regex.pattern, regex.flags))
+        lines += ['}',
+                  '_RUN = re.compile(RUN_PATTERN).match if RUN_PATTERN is not None else None']
+        lines += ['',
+                  '',
+                  'def _whole_span(regs):',
+                  '    return regs[:1]',
+                  '',
+                  '']
+        for key, (k, (master, spans, combined, separate)) in scanners.items():
+            pattern = master.__self__
+            groups = [pattern.groupindex['_%d' % i] for i in combined if i != self.run_index]
+            if groups:
+                spans = 'operator.itemgetter(%s)' % ', '.join(map(str, groups + [0]))
+            else:
+                spans = '_whole_span'
+            lines.append('%s = (re.compile(%r, %d).match, %s, %r, %r)'
+                         % (names[key], pattern.pattern, pattern.flags, spans, combined, separate))
+        lines.append('FULL = %s' % names[id(self.full)])
+        for source, name in matchers.items():
+            lines += ['', '', 'def %s(text, offset):' % name, source.rstrip('\n')]
+        lines += ['',
+                  '',
+                  'DISPATCH = (%s)' % ', '.join(dispatch)]
+        return '\n'.join(lines) + '\n' + GENERATED_LEXER_RUNTIME
+
+    def __character_matcher(self, char, scanner):
+        master, spans, combined, separate = scanner
+        candidates = combined + separate
+        node = self.literals.get(char)
+        if self.run_index is not None and combined == (self.run_index,):
+            return ('    length = _RUN(text, offset).end() - offset\n'
+                    '    return (%d, length) if length else (None, 0)\n' % self.run_index)
+        if not candidates and node is None:
+            return '    return None, 0\n'
+        if not candidates and list(node) == ['']:
+            index = node['']
+            if self.domains[index].priority < ErrorTerminal.priority:
+                return '    return None, 0\n'
+            return '    return %d, 1\n' % index
+        if not candidates:
+            return '    return _checked(*_match_literal(text, offset))\n'
+        if len(candidates) == 1 and node is None:
+            index = candidates[0]
+            regex = self.domains[index].re
+            shortest = 1 if self.domains[index].priority < ErrorTerminal.priority else 0
+            result = '%d' % index
+            if index in self.keywords:
+                result = 'KEYWORDS[%d].get(m.group(), %d)' % (index, index)
+            return ('    m = _MATCH[%d](text, offset)\n'
+                    '    if m is None:\n'
+                    '        return None, 0\n'
+                    '    length = m.end() - offset\n'
+                    '    return (%s, length) if length > %d else (None, 0)\n'
+                    % (index, result, shortest))
+        return None
+
+    @staticmethod
+    def __function_reference(func, index):
+        name = getattr(func, '__name__', None)
+        if name is not None and getattr(builtins, name, None) is func:
+            return name, None
+        module = getattr(func, '__module__', None)
+        qualname = getattr(func, '__qualname__', '')
+        if module in (None, '__main__') or '<' in qualname:
+            return None
+        target = sys.modules.get(module)
+        for part in qualname.split('.'):
+            target = getattr(target, part, None)
+        if target is None or target != func:
+            return None
+        head, _, tail = qualname.partition('.')
+        alias = '_ref%d' % index
+        return alias + ('.' + tail if tail else ''), f'from {module} import {head} as {alias}'
+
+    def __compile(self, regex, flags=0):
+        if not self.binary:
+            return re.compile(regex, flags)
+        try:
+            return re.compile(self.__encode(regex), flags & ~re.UNICODE)
+        except re.error as exc:
+            raise ValueError(f'Pattern {regex!r} cannot be compiled for bytes') from exc
+
+    @staticmethod
+    def __encode(image):
+        try:
+            return image.encode('ascii')
+        except UnicodeEncodeError as exc:
+            raise ValueError(f'{image!r} is not ASCII') from exc
+
+    def __add_literal(self, index, image):
+        if image == '':
+            return
+        node = self.literals
+        for char in self.__encode(image) if self.binary else image:
+            node = node.setdefault(char, {})
+        node.setdefault('', index)
+
+    @classmethod
+    def __combinable_regex(cls, domain):
+        flags = domain.re.flags & ~re.UNICODE
+        letters = ''
+        for flag, letter in cls.FLAG_LETTERS.items():
+            if flags & flag:
+                letters += letter
+                flags &= ~flag
+        if flags != 0 or domain.re.groupindex:
+            return None
+        if domain.re.groups > 0 and re.search(r'\\[1-9]|\(\?P=|\(\?\(', domain.regex):
+            return None
+
+        newline = '\n' if 'x' in letters else ''
+        piece = '(?%s:%s%s)' % (letters, domain.regex, newline)
+        try:
+            re.compile(piece)
+        except re.error:
+            return None
+        return piece
+
+    def match(self, text, offset):
+        scanner = self.first_char.get(text[offset], self.full) if offset < len(text) else self.full
+        master, spans, combined, separate = scanner
+        spans = spans(master(text, offset).regs)
+        best = max(spans, key=operator.itemgetter(1))
+        k = spans.index(best)
+        if k < len(combined):
+            index = combined[k]
+            length = best[1] - offset
+        else:
+            index, length = None, 0
+
+        for i in separate:
+            m = self.regexes[i].match(text, offset)
+            if m is not None:
+                index, length = self.__better(index, length, i, m.end() - offset)
+
+        if self.literals:
+            lit_index, lit_length = self.__match_literal(text, offset)
+            if lit_index is not None:
+                index, length = self.__better(index, length, lit_index, lit_length)
+
+        if index is None or length == 0:
+            return None, 0
+        if length == 1 and self.domains[index].priority < ErrorTerminal.priority:
+            return None, 0
+        if index in self.keywords:
+            index = self.keywords[index].get(text[offset:offset + length], index)
+        return index, length
+
+    def __better(self, index, length, other, other_length):
+        if index is None:
+            return other, other_length
+        current = (length, self.domains[index].priority, -index)
+        candidate = (other_length, self.domains[other].priority, -other)
+        return (other, other_length) if candidate > current else (index, length)
+
+    def __match_literal(self, text, offset):
+        node = self.literals
+        pos, end = offset, len(text)
+        index, length = None, 0
+        while pos < end:
+            node = node.get(text[pos])
+            if node is None:
+                break
+            pos += 1
+            if '' in node:
+                index, length = node[''], pos - offset
+        return index, length
+
+
+GENERATED_LEXER_RUNTIME = '''
+
+def _better(index, length, other, other_length):
+    if index is None:
+        return other, other_length
+    if (other_length, PRIORITIES[other], -other) > (length, PRIORITIES[index], -index):
+        return other, other_length
+    return index, length
+
+
+def _match_literal(text, offset):
+    node = LITERALS
+    pos, end = offset, len(text)
+    index, length = None, 0
+    while pos < end:
+        node = node.get(text[pos])
+        if node is None:
+            break
+        pos += 1
+        if '' in node:
+            index, length = node[''], pos - offset
+    return index, length
+
+
+def _checked(index, length):
+    if index is None or length == 0:
+        return None, 0
+    if length == 1 and PRIORITIES[index] < ERROR_PRIORITY:
+        return None, 0
+    return index, length
+
+
+def match(text, offset):
+    code = ord(text[offset]) if offset < len(text) else 128
+    if code < 128:
+        return DISPATCH[code](text, offset)
+    return _general(FULL, text, offset)
+
+
+def _general(scanner, text, offset, _end=operator.itemgetter(1)):
+    master, spans, combined, separate = scanner
+    spans = spans(master(text, offset).regs)
+    best = max(spans, key=_end)
+    k = spans.index(best)
+    if k < len(combined):
+        index = combined[k]
+        length = best[1] - offset
+    else:
+        index, length = None, 0
+
+    for i in separate:
+        m = _MATCH[i](text, offset)
+        if m is not None:
+            index, length = _better(index, length, i, m.end() - offset)
+
+    if LITERALS:
+        lit_index, lit_length = _match_literal(text, offset)
+        if lit_index is not None:
+            index, length = _better(index, length, lit_index, lit_length)
+
+    index, length = _checked(index, length)
+    if index in KEYWORDS:
+        index = KEYWORDS[index].get(text[offset:offset + length], index)
+    return index, length
+
+
+def bind(domains):
+    if tuple(str(domain) for domain in domains[:N_TERMINALS]) != NAMES:
+        raise ValueError('Domains do not match the generated lexer')
+    for i in UNBOUND:
+        FUNCS[i] = domains[i].func
+    UNBOUND.clear()
+
+
+def tokenize(text):
+    if UNBOUND:
+        raise RuntimeError('Attribute functions are not bound, call bind() first')
+    offset = 0
+    while offset < len(text):
+        index, length = match(text, offset)
+        if index is None:
+            raise ValueError(f'Unexpected character at offset {offset}')
+        if index in TRANSITIONS:
+            raise RuntimeError('Lexer modes are only supported through parser_edsl')
+        end = offset + length
+        if index < N_TERMINALS:
+            func = FUNCS[index]
+            attr = func(text[offset:end]) if func is not None else None
+            if index in INTERN and type(attr) is str:
+                attr = sys.intern(attr)
+            yield index, offset, end, attr
+        offset = end
+'''
+
+
+GENERATED_PARSER_FOLDS = '''
+
+def _simple(fold):
+    def extended_action(attrs, coords, res_coord):
+        return fold(*attrs)
+
+    return extended_action
+
+
+def _default_fold(*args):
+    if len(args) == 1:
+        return args[0]
+    elif len(args) == 0:
+        return None
+    else:
+        raise RuntimeError('__default_fold', args)
+
+'''
+
+
+GENERATED_PARSER_RUNTIME = '''
+
+class ParseError(Exception):
+    def __init__(self, pos, unexpected, expected, text=''):
+        super().__init__(pos, unexpected, expected)
+        self.pos = pos
+        self.unexpected = unexpected
+        self.expected = expected
         self.text = text
-        self.pos = Position()
-        self.skip_token = object()
-        self.domains += [Terminal('-skip-', regex, lambda _: self.skip_token)
-                         for regex in skip]
-        self.domains.append(ErrorTerminal())
 
-    def next_token(self):
+    @property
+    def message(self):
+        if self.text:
+            return self.text
+        expected = ', '.join(self.expected)
+        return f'Неожиданный символ {self.unexpected}, ожидалось {expected}'
+
+
+_IDS = {}
+
+
+def _terminal(symbol):
+    t = _IDS.get(symbol)
+    if t is None:
+        try:
+            t = _IDS[symbol] = TERMINALS.index(str(symbol))
+        except ValueError:
+            raise ValueError(f'Unknown terminal {symbol}') from None
+    return t
+
+
+_CONTEXT = {}
+
+
+def bind(folds):
+    # the folds of all rules, [fold.callee for _, _, fold, _ in
+    # parser.productions] of the grammar the module is generated for;
+    # those that could not be imported are taken from there
+    folds = list(folds)
+    if tuple(getattr(fold, '__name__', '') for fold in folds) != FOLD_NAMES:
+        raise ValueError('Folds do not match the generated parser')
+    for i in UNBOUND:
+        FOLDS[i] = folds[i]
+    UNBOUND.clear()
+
+
+def _expected(lexer):
+    # the terminals expected in each state, numbered as the lexer does
+    names = tuple(str(domain) for domain in lexer.domains[:lexer.engine.n_terminals])
+    expected = _CONTEXT.get(names)
+    if expected is None:
+        ids = {name: i for i, name in enumerate(names)}
+        expected = _CONTEXT[names] = [
+            frozenset(ids[name] for t, name in enumerate(TERMINALS) if mask >> t & 1 and name in ids)
+            for mask in EXPECTED]
+    return expected
+
+
+def _token_reader(tokens):
+    if not hasattr(tokens, 'next_token'):
+        tokens = iter(tokens)
+        return lambda state: next(tokens)
+    if not CONTEXT_LEXING or not hasattr(tokens, 'engine'):
+        return lambda state: tokens.next_token()
+    expected = _expected(tokens)
+    return lambda state: tokens.next_token(expected[state])
+
+
+def parse(tokens):
+    # tokens have type, pos and attr and end with EOF, as the tokens of
+    # parser_edsl.Parser.tokenize(); lexer errors come from them.  A lexer
+    # of parser_edsl.Parser.make_lexer() may be passed instead, it is then
+    # told the expected terminals if the grammar lexes by context
+    if UNBOUND:
+        raise RuntimeError('Folds are not bound, call bind() first')
+    next_token = _token_reader(tokens)
+    stack = [(0, None, None)]
+    cur = next_token(0)
+    t = _terminal(cur.type)
+
+    while True:
+        state, coord, top_attr = stack[-1]
+        index = ACTION_BASE[state] + t
+        if ACTION_CHECK[index] == state:
+            action = ACTION_NEXT[index]
+        elif EXPECTED[state] >> t & 1:
+            action = DEFAULT_REDUCE[state]
+        else:
+            action = 0
+
+        if action > 0:
+            stack.append((action - 1, cur.pos, cur.attr))
+            cur = next_token(action - 1)
+            t = _terminal(cur.type)
+        elif action < -1:
+            rule = -action - 1
+            n = RULE_LENGTH[rule]
+            entries = stack[len(stack) - n:]
+            attrs = [attr for _, _, attr in entries if attr != None]
+            coords = [coord for _, coord, _ in entries]
+            res_coord = coords[0].join(coords[-1]) if coords else cur.pos.at_start()
+            del stack[len(stack) - n:]
+            nt = RULE_LHS[rule]
+            index = GOTO_BASE[nt] + stack[-1][0]
+            goto = GOTO_NEXT[index] if GOTO_CHECK[index] == nt else DEFAULT_GOTO[nt]
+            stack.append((goto, res_coord, FOLDS[rule](attrs, coords, res_coord)))
+        elif action == -1:
+            return top_attr
+        elif state * len(TERMINALS) + t in NONASSOC:
+            raise ParseError(cur.pos.start, cur, [TERMINALS[t]], 'Неассоциативная операция')
+        else:
+            expected = [name for i, name in enumerate(TERMINALS) if EXPECTED[state] >> i & 1]
+            raise ParseError(cur.pos.start, cur, expected)
+'''
+
+
+NOT_BYTE_LEXABLE = re.compile(b'[\x1c-\x1f\x80-\xff]')
+
+PARALLEL_INPUT = None
+
+
+def lex_chunk(bounds):
+    engine, text = PARALLEL_INPUT
+    start, end = bounds
+    match, n_terminals = engine.match, engine.n_terminals
+    types, starts, ends = array.array('I'), array.array('q'), array.array('q')
+    offset = start
+    while offset < end:
+        i, length = match(text, offset)
+        if i is None:
+            return None
+        if i < n_terminals:
+            types.append(i)
+            starts.append(offset)
+            ends.append(offset + length)
+        offset += length
+    return (types, starts, ends) if offset == end else None
+
+
+class GeneratedLexerEngine(BaseLexerEngine):
+    def __init__(self, module, domains, skip):
+        self.skip = tuple(skip)
+        self.domains = list(domains)
+        self.n_terminals = len(self.domains)
+        self.domains += [skipped_domain_terminal(regex) for regex in self.skip]
+        self.run_index = module.RUN_INDEX
+        if self.run_index is not None:
+            self.domains.append(Terminal('-skip-', module.RUN_PATTERN, None, re_flags=0))
+        module.bind(self.domains)
+        self.match = module.match
+
+        # the module holds the initial mode only, other modes use LexerEngine
+        self.mode = INITIAL_MODE
+        self.engines = {INITIAL_MODE: self}
+        self.transitions = LexerEngine.mode_transitions(self.domains, INITIAL_MODE)
+
+
+
+@dataclasses.dataclass
+class TerminalStats:
+    domain : BaseTerminal
+    attempts : int = 0
+    matches : int = 0
+    tokens : int = 0
+    match_time : float = 0.0
+    matched_length : int = 0
+    attributes : int = 0
+    attribute_time : float = 0.0
+
+    @property
+    def average_length(self):
+        return self.matched_length / self.matches if self.matches else 0.0
+
+
+class LexerStats:
+    def __init__(self):
+        self.rows = {}
+        self.match_time = 0.0
+
+    def row(self, domain):
+        # a run of one skipped domain counts as that domain, a run of
+        # several as their union
+        sources = getattr(domain, 'sources', None)
+        if sources is not None and len(sources) == 1:
+            domain = sources[0]
+        key = domain if sources is None or len(sources) == 1 else sources
+        row = self.rows.get(key)
+        if row is None:
+            row = self.rows[key] = TerminalStats(domain)
+        return row
+
+    @property
+    def terminals(self):
+        return sorted(self.rows.values(), key=lambda row: -row.match_time - row.attribute_time)
+
+    def attribute(self, domain, text, begin, end, index=None):
+        start = time.perf_counter()
+        try:
+            return domain.attribute(text, begin, end, index)
+        finally:
+            row = self.row(domain)
+            row.attributes += 1
+            row.attribute_time += time.perf_counter() - start
+
+    def report(self):
+        lines = ['Lexer time: %.3f ms' % (self.match_time * 1000),
+                 '%-24s %9s %9s %9s %11s %8s %9s %11s' % (
+                     'terminal', 'attempts', 'matches', 'tokens', 'match ms',
+                     'avg len', 'attrs', 'attr ms')]
+        for row in self.terminals:
+            name = str(row.domain)
+            if getattr(row.domain, 'sources', None) is not None:
+                name = '-skip- ' + '|'.join(source.regex for source in row.domain.sources)
+            elif isinstance(row.domain, Terminal) and row.domain.name == '-skip-':
+                name = '-skip- ' + row.domain.regex
+            lines.append('%-24s %9d %9d %9d %11.3f %8.2f %9d %11.3f' % (
+                name[:24], row.attempts, row.matches, row.tokens, row.match_time * 1000,
+                row.average_length, row.attributes, row.attribute_time * 1000))
+        return '\n'.join(lines)
+
+
+class ProfilingLexerEngine(BaseLexerEngine):
+    # Lexes with the wrapped LexerEngine.  To tell which regex is slow it
+    # also matches on its own every domain that engine tries at the offset:
+    # the candidates of the scanner picked by the first character and the
+    # literals starting with it.  The master patterns only report all of
+    # them together.
+    def __init__(self, engine, stats):
+        self.engine = engine
+        self.stats = stats
+        self.domains = engine.domains
+        self.n_terminals = engine.n_terminals
+        self.skip = engine.skip
+        self.mode = engine.mode
+        self.transitions = engine.transitions
+        self.run_index = engine.run_index
+        self.binary = engine.binary
+        patterns = {}
+        for i in engine.order:
+            regex = engine.regexes[i]
+            if regex is None:
+                image = self.domains[i].image
+                regex = re.compile(re.escape(image.encode('ascii') if self.binary else image))
+            patterns[i] = (stats.row(self.domains[i]), regex.match)
+        for master, spans, combined, separate in engine.dispatch:
+            if combined == (self.run_index,):
+                patterns[self.run_index] = (stats.row(self.domains[self.run_index]), master)
+
+        self.literals = {char: [patterns[i] for i in self.__literal_indices(node)]
+                         for char, node in engine.literals.items()}
+        self.full = self.__candidates(engine.full, patterns)
+        self.first_char = {char: self.__candidates(scanner, patterns) + self.literals.get(char, [])
+                           for char, scanner in engine.first_char.items()}
+
+    @staticmethod
+    def __candidates(scanner, patterns):
+        master, spans, combined, separate = scanner
+        return [patterns[i] for i in combined + separate]
+
+    @staticmethod
+    def __literal_indices(node):
+        indices = []
+        for char, child in node.items():
+            if char == '':
+                indices.append(child)
+            else:
+                indices.extend(ProfilingLexerEngine.__literal_indices(child))
+        return indices
+
+    def for_mode(self, mode):
+        return ProfilingLexerEngine(self.engine.for_mode(mode), self.stats)
+
+    def restricted(self, terminals):
+        return ProfilingLexerEngine(self.engine.restricted(terminals), self.stats)
+
+    def match(self, text, offset):
+        clock = time.perf_counter
+        if offset < len(text):
+            candidates = self.first_char.get(text[offset])
+            if candidates is None:
+                candidates = self.full + self.literals.get(text[offset], [])
+        else:
+            candidates = self.full
+        for row, match in candidates:
+            start = clock()
+            m = match(text, offset)
+            row.match_time += clock() - start
+            row.attempts += 1
+            if m is not None:
+                row.matches += 1
+                row.matched_length += m.end() - offset
+
+        start = clock()
+        index, length = self.engine.match(text, offset)
+        self.stats.match_time += clock() - start
+        if index is not None:
+            self.stats.row(self.domains[index]).tokens += 1
+        return index, length
+
+
+class Lexer:
+    def __init__(self, domains, text, skip, engine=None, lazy_attributes=False):
+        if engine is None:
+            engine = LexerEngine(domains, skip)
+        self.engine = engine
+        self.domains = engine.domains
+        self.text = text
+        self.lazy_attributes = lazy_attributes
+        self.modes = [INITIAL_MODE]
+        self.restricted = {}
+        self.pos = Position()
+        self.stats = None
+
+    def position(self, offset):
+        return pos_from_offset(self.text, offset)
+
+    def _match_expected(self, text, offset, expected):
+        # a text the parser does not expect here is lexed with all terminals
+        # of the mode, so that the error names the unexpected token
+        engine = self.restricted.get(expected)
+        if engine is None:
+            engine = self.restricted[expected] = self.engine.restricted(expected)
+        index, length = engine.match(text, offset)
+        if index is None:
+            return self.engine.match(text, offset)
+        return index, length
+
+    def _change_mode(self, index, offset):
+        push, pop = self.engine.transitions[index]
+        if pop:
+            if len(self.modes) == 1:
+                raise LexerError(self.position(offset), self.text, offset=offset,
+                                 message='Нет режима для возврата')
+            self.modes.pop()
+        if push is not None:
+            self.modes.append(push)
+        self.engine = self.engine.for_mode(self.modes[-1])
+        self.restricted = {}
+
+    def next_token(self, expected=None):
         while self.pos.offset < len(self.text):
             offset = self.pos.offset
-            matches = [(d, d.priority, *d.match(self.text, offset))
-                       for d in self.domains]
-            domain, priority, length, attr = \
-                    max(matches, key=lambda t: (t[2], t[1]))
-
-            assert length > 0
+            if expected is None:
+                index, length = self.engine.match(self.text, offset)
+            else:
+                index, length = self._match_expected(self.text, offset, expected)
 
-            if attr == ErrorTerminal:
+            if index is None:
                 raise LexerError(self.pos, self.text)
+            if index in self.engine.transitions:
+                self._change_mode(index, offset)
 
             new_pos = self.pos.shift(self.text[offset:offset + length])
+            if self.engine.is_skip(index):
+                self.pos = new_pos
+                continue
             frag = Fragment(self.pos, new_pos)
             self.pos = new_pos
-            if attr != self.skip_token:
-                token = Token(domain, frag, attr)
-                return token
+            domain = self.domains[index]
+            attr = self._attribute(domain, offset, offset + length)
+            return Token(domain, frag, attr)
+
+        return Token(EOF_SYMBOL, Fragment(self.pos, self.pos), None)
+
+    def _attribute(self, domain, begin, end, index=None):
+        if self.lazy_attributes and isinstance(domain, Terminal):
+            return LazyAttribute(domain, self.text, begin, end, index)
+        if self.stats is not None:
+            return self.stats.attribute(domain, self.text, begin, end, index)
+        return domain.attribute(self.text, begin, end, index)
+
+    def profile(self, stats):
+        # the engine is wrapped, a generated one is replaced by a LexerEngine
+        engine = self.engine
+        if not isinstance(engine, LexerEngine):
+            engine = LexerEngine(self.domains[:engine.n_terminals], engine.skip, engine.mode)
+        self.engine = ProfilingLexerEngine(engine, stats)
+        self.restricted = {}
+        self.stats = stats
+
+    def _shift_attribute(self, attr, delta, index=None):
+        if type(attr) is LazyAttribute:
+            return LazyAttribute(attr.terminal, self.text, attr.begin + delta, attr.end + delta, index)
+        return attr
+
+    def fill(self, buffer):
+        while True:
+            token = self.next_token()
+            if token.type == EOF_SYMBOL:
+                buffer.end = self.token_span(token)[0]
+                return buffer
+            buffer.append(buffer.ids[token.type], *self.token_span(token), token.attr)
+
+    @staticmethod
+    def token_span(token):
+        if isinstance(token.pos, OffsetFragment):
+            return token.pos.begin, token.pos.end
+        return token.pos.start.offset, token.pos.following.offset
+
+    def relex(self, tokens, edit):
+        offset, removed, inserted = edit
+        text = self.text[:offset] + inserted + self.text[offset + removed:]
+        delta = len(inserted) - removed
+        edit_end = offset + len(inserted)
+        with_eof = len(tokens) > 0 and tokens[-1].type == EOF_SYMBOL
+
+        # The lexer state between tokens is just the offset, so lexing
+        # resumes after the last token that ends before the edit and stops
+        # as soon as it ends a token where some old token ended.  A token
+        # whose scan may have looked at the edit is lexed again as well,
+        # and so are the ones after it.
+        keep = bisect.bisect_left(tokens, offset,
+                                  key=lambda token: self.token_span(token)[1])
+        engine = self.engine.for_mode(INITIAL_MODE)
+        while keep > 0 and engine.may_look_at(self.text, self.token_span(tokens[keep - 1])[0], offset):
+            keep -= 1
+        # with lexer modes the state also holds the mode stack, which the
+        # tokens do not record, so everything is lexed again
+        self.engine = self.engine.for_mode(INITIAL_MODE)
+        self.modes = [INITIAL_MODE]
+        self.restricted = {}
+        modal = bool(self.engine.transitions)
+        if modal:
+            keep = 0
+        self._restart(text, tokens[keep - 1] if keep > 0 else None)
+
+        result = tokens[:keep]
+        old = keep
+        while True:
+            token = self.next_token()
+            if token.type == EOF_SYMBOL:
+                if with_eof:
+                    result.append(token)
+                return result
+            result.append(token)
+
+            end = self.token_span(token)[1]
+            if end <= edit_end or modal:
+                continue
+            while old < len(tokens) and self.token_span(tokens[old])[1] + delta < end:
+                old += 1
+            if old < len(tokens) and self.token_span(tokens[old])[1] + delta == end:
+                tail = tokens[old + 1:]
+                result += self._shift_tokens(tail, tokens[old], token, delta)
+                return result
+
+    def _restart(self, text, token):
+        self.text = text
+        self.pos = token.pos.following if token is not None else Position()
+
+    def _shift_tokens(self, tokens, old_anchor, new_anchor, delta):
+        old_end = old_anchor.pos.following
+        new_end = new_anchor.pos.following
+        line_delta = new_end.line - old_end.line
+        col_delta = new_end.col - old_end.col
+
+        def shift(pos):
+            col = pos.col + col_delta if pos.line == old_end.line else pos.col
+            return Position(pos.offset + delta, pos.line + line_delta, col)
+
+        return [Token(token.type, Fragment(shift(token.pos.start), shift(token.pos.following)),
+                      self._shift_attribute(token.attr, delta))
+                for token in tokens]
+
+
+class OffsetLexer(Lexer):
+    def __init__(self, domains, text, skip, engine=None, lazy_attributes=False):
+        super().__init__(domains, text, skip, engine, lazy_attributes)
+        self.offset = 0
+        self.index = LineIndex(text)
+        # what the engine matches over; attributes and errors use self.text
+        self.data = text
+
+    @property
+    def pos(self):
+        return self.index.position(self.offset)
+
+    def position(self, offset):
+        return self.index.position(offset)
+
+    @pos.setter
+    def pos(self, value):
+        self.offset = value.offset
+
+    def next_token(self, expected=None):
+        data, offset = self.data, self.offset
+        while offset < len(data):
+            if expected is None:
+                index, length = self.engine.match(data, offset)
+            else:
+                index, length = self._match_expected(data, offset, expected)
 
+            if index is None:
+                self.offset = offset
+                raise LexerError(self.pos, self.text)
+            if index in self.engine.transitions:
+                self._change_mode(index, offset)
+
+            end = offset + length
+            if not self.engine.is_skip(index):
+                self.offset = end
+                domain = self.domains[index]
+                attr = self._attribute(domain, offset, end, self.index)
+                return Token(domain, OffsetFragment(offset, end, self.index), attr)
+            offset = end
+
+        self.offset = offset
+        return Token(EOF_SYMBOL, OffsetFragment(offset, offset, self.index), None)
+
+    def fill(self, buffer, stop=None):
+        if buffer.symbols != tuple(self.domains[:self.engine.n_terminals]):
+            return super().fill(buffer)
+
+        data, text, offset, index = self.data, self.text, self.offset, self.index
+        match, n_terminals = self.engine.match, self.engine.n_terminals
+        transitions = self.engine.transitions
+        lazy, attribute = self.__lazy_domains(), self.__attribute_function()
+        stop = len(data) if stop is None else stop
+        while offset < stop:
+            i, length = match(data, offset)
+            if i is None:
+                self.offset = offset
+                raise LexerError(self.pos, text)
+            if i in transitions:
+                self._change_mode(i, offset)
+                match, transitions = self.engine.match, self.engine.transitions
+            end = offset + length
+            if i >= n_terminals:
+                pass
+            elif lazy[i]:
+                buffer.append_lazy(i, offset, end)
+            else:
+                attr = attribute(self.domains[i], text, offset, end, index)
+                buffer.append(i, offset, end, attr)
+            offset = end
+
+        self.offset = buffer.end = offset
+        return buffer
+
+    def append_spans(self, buffer, types, starts, ends):
+        text, index, domains = self.text, self.index, self.domains
+        lazy, attribute = self.__lazy_domains(), self.__attribute_function()
+        for i, begin, end in zip(types, starts, ends):
+            if lazy[i]:
+                buffer.append_lazy(i, begin, end)
+            else:
+                buffer.append(i, begin, end, attribute(domains[i], text, begin, end, index))
+        if len(ends) > 0:
+            self.offset = buffer.end = ends[-1]
+
+    def __lazy_domains(self):
+        return [self.lazy_attributes and isinstance(domain, Terminal)
+                for domain in self.domains[:self.engine.n_terminals]]
+
+    def __attribute_function(self):
+        # with profiling on, attributes are computed through the stats to be timed
+        if self.stats is not None:
+            return self.stats.attribute
+        return lambda domain, text, begin, end, index: domain.attribute(text, begin, end, index)
+
+    def _restart(self, text, token):
+        self.text = self.data = text
+        self.index = LineIndex(text)
+        self.offset = token.pos.end if token is not None else 0
+
+    def _shift_tokens(self, tokens, old_anchor, new_anchor, delta):
+        return [Token(token.type,
+                      OffsetFragment(token.pos.begin + delta, token.pos.end + delta, self.index),
+                      self._shift_attribute(token.attr, delta, self.index))
+                for token in tokens]
+
+
+class MappedLexer(OffsetLexer):
+    # Lexes a byte buffer, such as a memory-mapped file, with a binary
+    # engine: lexemes are decoded only when an attribute function needs
+    # them and offsets are byte offsets.
+    def __init__(self, domains, data, skip, engine, lazy_attributes=False):
+        super().__init__(domains, MappedText(data), skip, engine, lazy_attributes)
+        self.data = data
+        self.index = MappedLineIndex(data)
+
+    def _restart(self, text, token):
+        # the edited text is a str
+        super()._restart(text, token)
+        self.engine = LexerEngine(self.domains[:self.engine.n_terminals], self.engine.skip)
+
+
+class StreamLexer(Lexer):
+    def __init__(self, domains, source, skip, engine=None, *, positions='eager',
+                 max_token_length=4096, chunk_size=65536):
+        super().__init__(domains, '', skip, engine)
+        if hasattr(source, 'read'):
+            source = self.__read(source, chunk_size)
+        self.chunks = self.__decoded(source)
+        self.max_token_length = max_token_length
+        self.chunk_size = chunk_size
+        self.index = StreamLineIndex() if positions == 'offsets' else None
+        # self.text is a window over the stream; self.base is the stream
+        # offset of its first character and self.cursor the lexer position
+        self.base = 0
+        self.cursor = 0
+        self.eof = False
+
+    @staticmethod
+    def __read(source, chunk_size):
+        # a file ends at an empty read, '' in text mode and b'' in binary
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    @staticmethod
+    def __decoded(chunks):
+        # bytes are decoded as UTF-8, a character split between two chunks
+        # comes with the second one
+        decoder = None
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                yield chunk
+                continue
+            if not isinstance(chunk, (bytes, bytearray, memoryview)):
+                raise TypeError(f'Expected str or bytes chunks, got {type(chunk).__name__}')
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            yield decoder.decode(chunk)
+        if decoder is not None:
+            yield decoder.decode(b'', final=True)
+
+    def position(self, offset):
+        if self.index is not None:
+            return self.index.position(self.base + offset)
+        assert offset == self.cursor
+        return self.pos
+
+    def __fill(self):
+        needed = self.cursor + self.max_token_length + 1
+        if self.eof or len(self.text) >= needed:
+            return
+
+        if self.cursor > self.chunk_size:
+            # keep some consumed text so that ^, \b and lookbehinds still see it
+            drop = self.cursor - min(self.cursor, self.max_token_length)
+            self.text = self.text[drop:]
+            self.base += drop
+            self.cursor -= drop
+            needed -= drop
+
+        parts = [self.text]
+        size = len(self.text)
+        while size < needed:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            if self.index is not None:
+                self.index.feed(chunk)
+            parts.append(chunk)
+            size += len(chunk)
+        self.text = ''.join(parts)
+
+    def next_token(self, expected=None):
+        while True:
+            self.__fill()
+            offset = self.cursor
+            if offset >= len(self.text):
+                break
+
+            if expected is None:
+                index, length = self.engine.match(self.text, offset)
+            else:
+                index, length = self._match_expected(self.text, offset, expected)
+            if index is None:
+                raise LexerError(self.position(offset), self.text, offset=offset)
+            if index in self.engine.transitions:
+                self._change_mode(index, offset)
+
+            # the window always holds max_token_length + 1 characters past
+            # the cursor, so only an over-long token can reach its end
+            end = offset + length
+            if length > self.max_token_length and not self.engine.is_run(index):
+                raise LexerError(self.position(offset), self.text, offset=offset,
+                                 message=f'Лексема длиннее {self.max_token_length} символов')
+
+            if not self.engine.is_skip(index):
+                domain = self.domains[index]
+                attr = self._attribute(domain, offset, end, self)
+            if self.index is not None:
+                frag = OffsetFragment(self.base + offset, self.base + end, self.index)
+            else:
+                new_pos = self.pos.shift(self.text[offset:end])
+                frag = Fragment(self.pos, new_pos)
+                self.pos = new_pos
+            self.cursor = end
+            if not self.engine.is_skip(index):
+                return Token(domain, frag, attr)
+
+        offset = self.base + self.cursor
+        if self.index is not None:
+            return Token(EOF_SYMBOL, OffsetFragment(offset, offset, self.index), None)
         return Token(EOF_SYMBOL, Fragment(self.pos, self.pos), None)
 
+
+class PipelinedLexer:
+    # Runs a lexer on a producer thread that hands tokens over in batches
+    # through a bounded queue.  An exception is queued after the tokens that
+    # precede it, so the parser meets it where it would without the thread.
+    BATCH_SIZE = 512
+    MAX_BATCHES = 16
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.queue = queue.Queue(self.MAX_BATCHES)
+        self.batch = []
+        self.next = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.__produce, daemon=True)
+        self.thread.start()
+
+    def __produce(self):
+        batch = []
+        try:
+            while not self.stopped:
+                token = self.lexer.next_token()
+                batch.append(token)
+                if token.type == EOF_SYMBOL:
+                    break
+                if len(batch) == self.BATCH_SIZE:
+                    self.queue.put(batch)
+                    batch = []
+        except Exception as exc:
+            batch.append(exc)
+        self.queue.put(batch)
+
+    def next_token(self, expected=None):
+        if self.next == len(self.batch):
+            self.batch = self.queue.get()
+            self.next = 0
+        item = self.batch[self.next]
+        self.next += 1
+        if isinstance(item, Exception):
+            self.batch, self.next = [item], 0
+            raise item
+        return item
+
+    def close(self):
+        # the producer may be blocked on a full queue
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self.thread.join()
+
+
 @dataclasses.dataclass(frozen=True)
 class EarleyState:
     rule: tuple
@@ -1148,13 +3815,22 @@ class EarleyParser:
     def __init__(self, grammar: Parser):
         self.grammar = grammar
         self.chart = collections.defaultdict(set)
+        self.tokens = ()
 
     def predict(self, state, pos, coords, states):
         if not isinstance(coords, tuple):
             coords = (coords,)
         next_sym = state.next_symbol()
         if isinstance(next_sym, NonTerminal):
-            for prod, fold, _ in next_sym.enum_rules():
+            # a production is only predicted if it can start with the next
+            # token or derive the empty string
+            grammar = self.grammar
+            offset = grammar.nonterm_offset[next_sym]
+            token = grammar.terminal_bits.get(self.tokens[pos].type, 0) if pos < len(self.tokens) else 0
+            for k, (prod, fold, _) in enumerate(next_sym.enum_rules()):
+                mask, nullable = grammar.suffix_first[offset + k][0]
+                if not (nullable or mask & token):
+                    continue
                 new_state = EarleyState((next_sym, tuple(prod), fold),
                                         0,
                                         pos,
@@ -1169,13 +3845,14 @@ class EarleyParser:
         next_sym = state.next_symbol()
         if (isinstance(next_sym, LiteralTerminal) or isinstance(next_sym, Terminal)) and next_sym == token.type:
             new_attrs = []
+            attr = resolve_attribute(token.attr)
 
-            if token.attr is None:
+            if attr is None:
                 new_attrs = state.attrs
-            elif not isinstance(state, list) or len(token.attr) > 1:
-                new_attrs = state.attrs + [token.attr]
+            elif not isinstance(state, list) or len(attr) > 1:
+                new_attrs = state.attrs + [attr]
             else:
-                new_attrs = state.attrs + token.attr
+                new_attrs = state.attrs + attr
 
             new_coords = state.coords + (token.pos,)
             new_state = EarleyState(state.rule,
@@ -1187,7 +3864,7 @@ class EarleyParser:
             if new_state.is_complete():
                 _, _, fold = new_state.rule
                 coords = new_state.coords
-                res_coord = Fragment(coords[0].start, coords[-1].following)
+                res_coord = coords[0].join(coords[-1])
                 res_attr = fold.callee(new_attrs, coords, res_coord)
 
                 new_state = EarleyState(state.rule, state.dot + 1, state.start, pos + 1, [res_attr], new_coords)
@@ -1233,7 +3910,7 @@ class EarleyParser:
                         #     attrs = [new_state.attrs]
                     attrs = new_state.attrs
                     coords = new_state.coords
-                    res_coord = Fragment(coords[0].start, coords[-1].following)
+                    res_coord = coords[0].join(coords[-1])
 
                     res_attr = []
 
@@ -1244,6 +3921,7 @@ class EarleyParser:
 
 
     def parse(self, tokens):
+        self.tokens = tokens
         start_rule = (self.grammar.nonterms[0], tuple(self.grammar.productions[0][1]), self.grammar.productions[0][2])
         self.chart[0].add(EarleyState(start_rule, 0, 0, 0))
 